@@ -0,0 +1,501 @@
+"""
+离线基准测试：用伪造的 AstrMessageEvent 驱动 CustomCommandPlugin.handle_message，
+测量消息吞吐、处理延迟（p50/p99）以及事件循环被阻塞的时间。
+
+需要在已安装 AstrBot 的环境中运行（插件依赖 astrbot.api）：
+
+    python benchmark.py --keywords 5000 --mix 8:1:1 --messages 20000
+    python benchmark.py --whitelist --latency 50 --error-rate 0.05 --json base.json
+    python benchmark.py --keywords 5000 --baseline base.json
+    python benchmark.py --scenario concurrent --concurrency 50 --latency 200
+    python benchmark.py --scenario persist --edits 1000 --persist-delay 0.05
+    python benchmark.py --scenario fuzzy --sizes 100,1000,10000
+    python benchmark.py --scenario accessor --messages 200000
+
+接口类关键词指向本地启动的模拟 HTTP 服务，延迟与错误率可配置。
+--scenario 选择测试场景（默认 throughput 为上面的消息吞吐测试）：
+  concurrent  同时触发多个 GET 关键词，检查模拟服务是否在同一时间处理这些请求
+  persist     连续执行 --edits 次 add_reply，检查落盘次数远少于修改次数且重新加载后内容完整
+  fuzzy       不同词库规模下对比模糊匹配自动机与逐个 `keyword in msg` 的单条消息耗时
+  accessor    多种事件类型混合时，对比按类型缓存取值方式与每次完整探测取文本/发送者ID的耗时
+场景带有检查项时，结果中的 ok 为 False 则以退出码 1 结束。
+插件数据写入临时目录，不会影响真实的 data/plugins 配置。
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeEvent:
+    """最小化的消息事件：只提供插件用到的接口"""
+
+    __slots__ = ("message_str", "_sender", "_group", "unified_msg_origin")
+
+    def __init__(self, text: str, sender: str, group: str = ""):
+        self.message_str = text
+        self._sender = sender
+        self._group = group
+        self.unified_msg_origin = f"bench:GroupMessage:{group}" if group else f"bench:FriendMessage:{sender}"
+
+    def get_sender_id(self):
+        return self._sender
+
+    def get_group_id(self):
+        return self._group
+
+    def plain_result(self, text):
+        return text
+
+
+class MethodEvent:
+    """只提供取值方法的平台事件"""
+
+    def __init__(self, text: str, sender: str):
+        self._text, self._sender = text, sender
+
+    def get_message_str(self):
+        return self._text
+
+    def get_sender_id(self):
+        return self._sender
+
+
+class _Sender:
+    __slots__ = ("id",)
+
+    def __init__(self, uid: str):
+        self.id = uid
+
+
+class _Message:
+    __slots__ = ("text",)
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class NestedEvent:
+    """文本在 message.text、发送者在 sender.id 的平台事件，需要探测到最后几项才能命中"""
+
+    def __init__(self, text: str, sender: str):
+        self.message = _Message(text)
+        self.sender = _Sender(sender)
+
+
+class AttrEvent:
+    """用普通属性提供 text 与 user_id 的平台事件"""
+
+    def __init__(self, text: str, sender: str):
+        self.text = text
+        self.user_id = sender
+
+
+def start_stub_server(latency: float, error_rate: float, stats: dict | None = None) -> tuple[ThreadingHTTPServer, str]:
+    """启动模拟面板：按给定延迟响应，按错误率返回 503；传入 stats 时记录请求总数与同时处理的请求数峰值"""
+    body = json.dumps({"attributes": {"current_state": "running",
+                                      "resources": {"memory_bytes": 1 << 30, "cpu_absolute": 12.5}}}).encode()
+    if stats is None:
+        stats = {}
+    stats.update(requests=0, inflight=0, peak_inflight=0)
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            if length:
+                self.rfile.read(length)
+            with lock:
+                stats["requests"] += 1
+                stats["inflight"] += 1
+                stats["peak_inflight"] = max(stats["peak_inflight"], stats["inflight"])
+            try:
+                if latency > 0:
+                    time.sleep(latency)
+            finally:
+                with lock:
+                    stats["inflight"] -= 1
+            status = 503 if random.random() < error_rate else 200
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = _reply
+        do_POST = _reply
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        daemon_threads = True
+        # 默认的 listen backlog 只有 5，大量连接同时建立时会触发 SYN 重传，拖慢并发场景
+        request_queue_size = 256
+
+    server = Server(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def build_library(n: int, mix: tuple[int, int, int], base_url: str) -> tuple[dict, list, list]:
+    """生成 n 个关键词，按 文本:GET:POST 比例分配，返回 (command_map, 文本关键词, 接口关键词)"""
+    total = sum(mix) or 1
+    n_get = n * mix[1] // total
+    n_post = n * mix[2] // total
+    n_text = n - n_get - n_post
+    command_map, text_keys, api_keys = {}, [], []
+    for i in range(n_text):
+        k = f"词{i}号"
+        command_map[k] = f"回复{i}"
+        text_keys.append(k)
+    for i in range(n_get):
+        k = f"状态{i}"
+        command_map[k] = {"type": "get_api", "endpoint": f"{base_url}/servers/{i}/resources", "token_index": 0}
+        api_keys.append(k)
+    for i in range(n_post):
+        k = f"重启{i}"
+        command_map[k] = {"type": "post_api", "endpoint": f"{base_url}/servers/{i}/power",
+                          "payload": {"signal": "restart"}, "code_map": {204: "已重启"}, "token_index": 0}
+        api_keys.append(k)
+    return command_map, text_keys, api_keys
+
+
+def build_messages(count: int, text_keys: list, api_keys: list, hit_rate: float, api_rate: float) -> list[str]:
+    """生成消息序列：hit_rate 比例命中关键词（其中 api_rate 比例为接口关键词，其余一半精确一半模糊）"""
+    messages = []
+    for i in range(count):
+        r = random.random()
+        if r >= hit_rate or not (text_keys or api_keys):
+            messages.append(f"今天天气不错，随便聊聊第{i}句，没有任何关键词")
+        elif api_keys and (random.random() < api_rate or not text_keys):
+            messages.append(random.choice(api_keys))
+        elif random.random() < 0.5:
+            messages.append(random.choice(text_keys))
+        else:
+            messages.append(f"我想问一下{random.choice(text_keys)}是什么意思")
+    return messages
+
+
+async def monitor_loop(stop: asyncio.Event, tick: float, lags: list):
+    """每 tick 秒醒来一次，记录实际醒来时间与预期的差值，即事件循环被阻塞的时间"""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(tick)
+        lag = loop.time() - start - tick
+        if lag > 0:
+            lags.append(lag)
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+def new_plugin():
+    from astrbot.api.all import Context
+    from main import CustomCommandPlugin
+
+    plugin = CustomCommandPlugin(Context())
+    plugin.settings["reload_interval"] = 0
+    return plugin
+
+
+async def run_concurrent(args) -> dict:
+    """--concurrency 个不同的 GET 关键词同时触发：请求应并行发出，总耗时接近单次延迟而不是逐个累加"""
+    stats: dict = {}
+    latency = args.latency / 1000
+    server, base_url = start_stub_server(latency, 0.0, stats)
+    plugin = new_plugin()
+    n = max(1, args.concurrency)
+    # 单主机并发上限放开到触发数，测的是事件循环能否同时等待这些请求
+    plugin.settings["http_max_per_host"] = n
+    plugin.command_map = {f"状态{i}": {"type": "get_api", "endpoint": f"{base_url}/servers/{i}/resources",
+                                     "token_index": 0} for i in range(n)}
+    plugin._rebuild_index()
+    plugin.token_list = ["bench-token-0000"]
+    plugin.whitelist_enabled = False
+    replies: list[str] = []
+
+    async def one(i):
+        async for r in plugin.handle_message(FakeEvent(f"状态{i}", str(10000 + i))):
+            replies.append(r)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(n)))
+    elapsed = time.perf_counter() - start
+    await plugin.terminate()
+    server.shutdown()
+
+    serial = n * latency
+    failed = sum(1 for r in replies if str(r).startswith("❌"))
+    return {
+        "scenario": "concurrent",
+        "triggers": n,
+        "latency_ms": args.latency,
+        "replies": len(replies),
+        "failed_replies": failed,
+        "server_requests": stats["requests"],
+        "server_peak_inflight": stats["peak_inflight"],
+        "elapsed_s": round(elapsed, 4),
+        "serial_estimate_s": round(serial, 4),
+        # 全部成功回复，且明显快于逐个请求（有延迟时），服务端同时看到不止一个请求
+        "ok": len(replies) == n and failed == 0 and (n == 1 or stats["peak_inflight"] > 1)
+              and (latency <= 0 or elapsed < serial / 2 + latency),
+    }
+
+
+async def run_persist(args) -> dict:
+    """短合并窗口下快速连续添加关键词：写盘次数应远少于修改次数，卸载后重新加载的词库不丢修改"""
+    plugin = new_plugin()
+    plugin.persister.delay = args.persist_delay
+    writes_before = plugin.persister.writes
+    expected = dict(plugin.command_map)
+    admin = FakeEvent("", "bench-admin")
+    start = time.perf_counter()
+    for i in range(args.edits):
+        key, reply = f"批量词{i}", f"批量回复{i}"
+        expected[key] = reply
+        async for _ in plugin.add_reply(admin, key, reply):
+            pass
+        if i % 50 == 49:
+            # 模拟管理员分批操作，让修改跨越多个合并窗口
+            await asyncio.sleep(args.persist_delay / 5)
+    elapsed = time.perf_counter() - start
+    await plugin.terminate()
+    writes = plugin.persister.writes - writes_before
+
+    with open(plugin.config_path, "r", encoding="utf-8") as f:
+        on_disk = json.load(f)
+    reloaded = new_plugin()
+    reloaded_map = dict(reloaded.command_map)
+    await reloaded.terminate()
+    return {
+        "scenario": "persist",
+        "edits": args.edits,
+        "persist_delay_s": args.persist_delay,
+        "disk_writes": writes,
+        "edit_s": round(elapsed, 4),
+        "file_matches": on_disk == expected,
+        "reload_matches": reloaded_map == expected,
+        # 至少要比每次修改都写一次少一个数量级，且文件与重新加载的结果都不丢修改
+        "ok": 0 < writes <= max(1, args.edits // 10) and on_disk == expected and reloaded_map == expected,
+    }
+
+
+async def run_fuzzy(args) -> dict:
+    """模糊匹配：自动机的耗时应基本不随关键词数增长，逐个扫描则线性增长；两者结果必须一致"""
+    from main import KeywordIndex
+
+    random.seed(args.seed)
+    result: dict = {"scenario": "fuzzy", "messages": args.messages}
+    mismatches = 0
+    for n in args.sizes:
+        command_map, text_keys, _ = build_library(n, (1, 0, 0), "")
+        messages = build_messages(args.messages, text_keys, [], args.hit_rate, 0.0)
+        index = KeywordIndex(command_map)
+
+        t0 = time.perf_counter()
+        found = [index.search(m) for m in messages]
+        t_index = time.perf_counter() - t0
+
+        # 原先的实现：按插入顺序逐个判断关键词是否是消息的子串
+        t0 = time.perf_counter()
+        expected = [next((k for k, v in command_map.items() if isinstance(v, str) and k in m), None)
+                    for m in messages]
+        t_linear = time.perf_counter() - t0
+
+        mismatches += sum(1 for a, b in zip(found, expected) if a != b)
+        result[f"index_us@{n}"] = round(t_index / len(messages) * 1e6, 2)
+        result[f"linear_us@{n}"] = round(t_linear / len(messages) * 1e6, 2)
+    result["mismatches"] = mismatches
+    result["ok"] = mismatches == 0
+    return result
+
+
+async def run_accessor(args) -> dict:
+    """多种事件类型混合时取文本与发送者ID：按类型缓存后的耗时对比每次完整探测，两者结果必须一致"""
+    from main import _probe_event_text, _probe_sender_id
+
+    plugin = new_plugin()
+    classes = (FakeEvent, MethodEvent, NestedEvent, AttrEvent)
+    events = [classes[i % len(classes)](f"消息{i}", str(10000 + i % 97)) for i in range(min(args.messages, 1000))]
+    rounds = max(1, args.messages // len(events))
+    get_text, get_sender = plugin._get_event_text, plugin._get_sender_id
+
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        for ev in events:
+            get_text(ev)
+            get_sender(ev)
+    t_cached = time.perf_counter() - t0
+
+    # 缓存之前的做法：每条消息都从头探测一遍
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        for ev in events:
+            _probe_event_text(ev)
+            _probe_sender_id(ev)
+    t_probe = time.perf_counter() - t0
+
+    mismatches = sum(1 for ev in events
+                     if (get_text(ev), get_sender(ev)) != (_probe_event_text(ev)[0], _probe_sender_id(ev)[0]))
+    await plugin.terminate()
+    calls = rounds * len(events)
+    return {
+        "scenario": "accessor",
+        "event_classes": len(classes),
+        "lookups": calls,
+        "cached_ns": round(t_cached / calls * 1e9, 1),
+        "probe_ns": round(t_probe / calls * 1e9, 1),
+        "speedup": round(t_probe / t_cached, 2) if t_cached else 0.0,
+        "mismatches": mismatches,
+        "ok": mismatches == 0,
+    }
+
+
+async def run(args) -> dict:
+    if args.scenario == "accessor":
+        return await run_accessor(args)
+    if args.scenario == "fuzzy":
+        return await run_fuzzy(args)
+    if args.scenario == "concurrent":
+        return await run_concurrent(args)
+    if args.scenario == "persist":
+        return await run_persist(args)
+
+    random.seed(args.seed)
+    server, base_url = start_stub_server(args.latency / 1000, args.error_rate)
+    plugin = new_plugin()
+    command_map, text_keys, api_keys = build_library(args.keywords, args.mix, base_url)
+    plugin.command_map = command_map
+    plugin._rebuild_index()
+    plugin.token_list = ["bench-token-0000"]
+    senders = [str(10000 + i) for i in range(args.senders)]
+    plugin.whitelist_enabled = args.whitelist
+    plugin.whitelist = set(senders[: max(1, len(senders) * 9 // 10)])
+
+    messages = build_messages(args.messages, text_keys, api_keys, args.hit_rate, args.api_rate)
+    events = [FakeEvent(m, random.choice(senders), random.choice(("", "group1", "group2"))) for m in messages]
+    latencies: list[float] = []
+    replies = 0
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def one(ev):
+        nonlocal replies
+        async with sem:
+            t0 = time.perf_counter()
+            async for _ in plugin.handle_message(ev):
+                replies += 1
+            latencies.append(time.perf_counter() - t0)
+
+    lags: list[float] = []
+    stop = asyncio.Event()
+    monitor = asyncio.ensure_future(monitor_loop(stop, 0.005, lags))
+    start = time.perf_counter()
+    await asyncio.gather(*(one(ev) for ev in events))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await monitor
+    await plugin.terminate()
+    server.shutdown()
+
+    return {
+        "keywords": args.keywords,
+        "messages": len(events),
+        "replies": replies,
+        "elapsed_s": round(elapsed, 4),
+        "msgs_per_s": round(len(events) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3) if latencies else 0.0,
+        "loop_blocked_ms": round(sum(lags) * 1000, 1),
+        "loop_max_stall_ms": round(max(lags, default=0.0) * 1000, 2),
+    }
+
+
+def parse_mix(raw: str) -> tuple[int, int, int]:
+    parts = [int(x) for x in raw.split(":")]
+    if len(parts) != 3 or min(parts) < 0:
+        raise argparse.ArgumentTypeError("mix 格式为 文本:GET:POST，例如 8:1:1")
+    return parts[0], parts[1], parts[2]
+
+
+def parse_sizes(raw: str) -> tuple[int, ...]:
+    try:
+        sizes = tuple(int(x) for x in raw.split(",") if x.strip())
+    except ValueError:
+        sizes = ()
+    if not sizes or min(sizes) <= 0:
+        raise argparse.ArgumentTypeError("sizes 格式为逗号分隔的正整数，例如 100,1000,10000")
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CustomCommandPlugin 消息处理基准测试")
+    parser.add_argument("--scenario", choices=("throughput", "concurrent", "persist", "fuzzy", "accessor"), default="throughput",
+                        help="测试场景，见文件开头的说明")
+    parser.add_argument("--keywords", type=int, default=1000, help="关键词数量")
+    parser.add_argument("--mix", type=parse_mix, default=(8, 1, 1), help="文本:GET:POST 关键词比例")
+    parser.add_argument("--messages", type=int, default=5000, help="发送的消息条数")
+    parser.add_argument("--concurrency", type=int, default=50, help="同时处理的消息数")
+    parser.add_argument("--senders", type=int, default=200, help="不同发送者数量")
+    parser.add_argument("--whitelist", action="store_true", help="开启白名单（约 10%% 发送者不在名单内）")
+    parser.add_argument("--hit-rate", type=float, default=0.3, help="消息命中关键词的比例")
+    parser.add_argument("--api-rate", type=float, default=0.2, help="命中消息中接口关键词的比例")
+    parser.add_argument("--latency", type=float, default=20.0, help="模拟面板的响应延迟（毫秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟面板返回 503 的比例")
+    parser.add_argument("--sizes", type=parse_sizes, default=(100, 1000, 10000),
+                        help="fuzzy 场景依次测试的关键词数量，逗号分隔")
+    parser.add_argument("--edits", type=int, default=500, help="persist 场景中连续添加的关键词数")
+    parser.add_argument("--persist-delay", type=float, default=0.05, help="persist 场景的合并写入窗口（秒）")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", dest="json_out", help="把结果写入 JSON 文件，作为后续对比的基线")
+    parser.add_argument("--baseline", help="与之前保存的基线 JSON 对比")
+    args = parser.parse_args()
+
+    # 插件会在工作目录下创建 data/plugins/...，放到临时目录避免污染真实配置
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="custom_command_bench_") as tmp:
+        os.chdir(tmp)
+        try:
+            result = asyncio.run(run(args))
+        finally:
+            os.chdir(cwd)
+
+    width = max(len(k) for k in result)
+    for k, v in result.items():
+        print(f"{k:<{width}}  {v}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            base = json.load(f)
+        print("\n与基线对比：")
+        for k in ("msgs_per_s", "p50_ms", "p99_ms", "loop_blocked_ms", "loop_max_stall_ms"):
+            if k in base and k in result and base[k]:
+                change = (result[k] - base[k]) / base[k] * 100
+                print(f"{k:<{width}}  {base[k]} -> {result[k]} ({change:+.1f}%)")
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if result.get("ok") is False:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,1496 @@
 from astrbot.api.all import *
 from astrbot.api.event.filter import command, permission_type, event_message_type, EventMessageType, PermissionType
+import asyncio
+import csv
 import json
 import logging
 import os
+import random
+import re
+import sqlite3
+import tempfile
+import time
+from collections import OrderedDict, deque
+from operator import attrgetter, methodcaller
+from types import FunctionType
+from urllib.parse import urlsplit
 import requests
 
+try:
+    import httpx
+except ImportError:  # 宿主未安装 httpx 时回退为线程池中的 requests
+    httpx = None
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
 logger = logging.getLogger("CustomCommandPlugin")
 
+# 插件级设置默认值，可通过 /插件设置 修改并持久化到 plugin_settings.json
+DEFAULT_SETTINGS = {
+    "http_timeout": 10,            # 单次请求超时（秒）
+    "http_max_connections": 100,   # 连接池总连接数上限
+    "http_max_keepalive": 20,      # 保持存活的空闲连接数上限
+    "http_max_per_host": 10,       # 单个主机的并发请求上限
+    "http_max_body_bytes": 1048576,  # 单个响应体的读取上限（字节），超出即中止读取并报错
+    "reply_max_chars": 4000,       # 未设置模板的接口回复的最大字符数，超出部分截断
+    "cache_max_entries": 512,      # GET 响应缓存条目上限（LRU 淘汰）
+    "token_rate": 0,               # 每个令牌每秒允许的请求数，0 表示不限速
+    "token_burst": 5,              # 令牌桶容量（允许的突发请求数）
+    "token_limits": {},            # 按索引覆盖限速：{"1": {"rate": 2, "burst": 4}}
+    "token_bench_seconds": 60,     # 令牌收到 429 后暂停调度的秒数
+    "breaker_failure_threshold": 5,  # 同一主机连续失败（超时/连接错误/5xx）多少次后熔断，0 表示关闭熔断
+    "breaker_open_seconds": 30,      # 熔断后多久放行半开探测请求
+    "breaker_half_open_probes": 1,   # 半开状态同时放行的探测请求数
+    "breaker_reply": "⚠️ 接口暂时不可用，请稍后再试",  # 熔断期间且没有可用旧结果时的快速回复
+    "debug_log": False,            # 是否输出逐条消息的调试日志
+    "debug_sample_rate": 1.0,      # 调试日志的消息采样比例（0~1）
+    "storage_backend": "json",     # 关键词/白名单/令牌的存储方式：json 或 sqlite（重载插件后生效）
+    "persist_delay": 1.0,          # JSON 文件延迟合并写入的窗口（秒），窗口内的多次修改只写一次
+    "reload_interval": 3.0,        # 检查词库/白名单/令牌文件是否被外部修改的间隔（秒），0 表示不检查
+    "metrics_prom_path": "",       # Prometheus 文本格式的指标导出文件（相对插件数据目录），留空不导出
+    "metrics_dump_interval": 15,   # 指标导出文件的刷新间隔（秒）
+    "list_page_size": 20,          # /查看自定义回复 每页显示的条数
+    "cooldown_sender": 0,          # 同一发送者两次触发关键词的最小间隔（秒），0 表示不限制
+    "cooldown_keyword": 0,         # 同一关键词两次被触发的最小间隔（秒），关键词自身的 cooldown 优先
+    "cooldown_group": 0,           # 同一群内两次触发关键词的最小间隔（秒）
+    "cooldown_api_only": False,    # 只对接口关键词应用冷却，文本回复不受限制
+    "cooldown_max_tracked": 100000,  # 冷却表最多记录的发送者/关键词/群数量，超出时淘汰最早的记录
+    "queue_workers": 0,            # 接口关键词任务队列的 worker 数，0 表示不排队、在消息处理中直接请求
+    "queue_max_depth": 100,        # 排队等待的任务数上限
+    "queue_policy": "reject",      # 队列满时的处理：reject 回复繁忙 / drop_oldest 丢弃最早的任务 / collapse 合并相同关键词
+    "queue_busy_reply": "⚠️ 当前请求较多，请稍后再试",  # 任务被拒绝或被挤出队列时的回复
+    "queue_ack": "",               # 非空时先立即回复该文本，接口结果稍后单独发送
+    "fanout_concurrency": 5,       # 批量接口关键词同时请求的目标数上限（关键词的 concurrency 优先）
+    "fanout_timeout": 10,          # 批量接口中单个目标的超时（秒，关键词的 timeout 优先）
+    "poll_idle_seconds": 300,      # 开启轮询的关键词超过该时长无人触发则暂停轮询（秒）
+    "poll_jitter": 0.1,            # 轮询间隔的随机抖动比例，避免多个关键词同时请求
+    "typo_match": False,           # 精确与子串匹配都未命中时，按编辑距离容错匹配最接近的关键词
+    "typo_max_distance": 1,        # 容错匹配允许的最大编辑距离
+    "typo_min_similarity": 0.6,    # 容错匹配的最低相似度（1 - 编辑距离 / 较长一方的长度）
+}
+
+def _setting_type_ok(key: str, value) -> bool:
+    """设置值的类型须与默认值一致（数字类可互换 int/float，bool 不算数字）"""
+    default = DEFAULT_SETTINGS[key]
+    if isinstance(default, bool):
+        return isinstance(value, bool)
+    if isinstance(default, (int, float)):
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    return isinstance(value, type(default))
+
+
+_HTTP_STATUS_ERRORS = (requests.HTTPError,) + ((httpx.HTTPStatusError,) if httpx is not None else ())
+
+
+class KeywordIndex:
+    """
+    文本关键词的 Aho-Corasick 自动机，用于模糊匹配（关键词是消息的子串）。
+    一次扫描消息即可找出全部命中的关键词，并返回插入顺序最靠前的那个，
+    与原先按 command_map 顺序逐个 `keyword in msg` 的结果保持一致。
+    """
+
+    __slots__ = ("_goto", "_fail", "_best", "_keywords")
+
+    def __init__(self, command_map: dict | None = None):
+        self._goto: list[dict] = [{}]
+        self._fail: list[int] = [0]
+        # 每个节点（含失败链）可命中的最小插入序号，-1 表示无
+        self._best: list[int] = [-1]
+        self._keywords: list[str] = []
+        if command_map:
+            self._build(command_map)
+
+    def _build(self, command_map: dict):
+        goto, best = self._goto, self._best
+        for keyword, reply in command_map.items():
+            if not isinstance(reply, str) or not isinstance(keyword, str):
+                continue
+            order = len(self._keywords)
+            self._keywords.append(keyword)
+            node = 0
+            for ch in keyword:
+                nxt = goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[node][ch] = nxt
+                    goto.append({})
+                    best.append(-1)
+                node = nxt
+            if best[node] == -1:
+                best[node] = order
+
+        # BFS 构造失败指针，并把失败链上的最小序号合并到节点上
+        fail = self._fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in goto[node].items():
+                f = fail[node]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                fb = best[fail[nxt]]
+                if fb != -1 and (best[nxt] == -1 or fb < best[nxt]):
+                    best[nxt] = fb
+                queue.append(nxt)
+
+    def __len__(self) -> int:
+        return len(self._keywords)
+
+    def search(self, text: str) -> str | None:
+        """返回 text 中出现的、插入顺序最靠前的关键词；无命中返回 None。"""
+        if not self._keywords:
+            return None
+        goto, fail, best = self._goto, self._fail, self._best
+        found = best[0]
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            b = best[node]
+            if b != -1 and (found == -1 or b < found):
+                found = b
+                if found == 0:
+                    break
+        return self._keywords[found] if found != -1 else None
+
+class ResponseTooLarge(Exception):
+    """响应体超出上限；status 为服务端实际返回的状态码，接口本身是可用的，不计入熔断失败"""
+
+    def __init__(self, limit: int, status: int | None = None):
+        super().__init__(f"响应体超过 {limit} 字节上限")
+        self.status = status
+
+
+def _read_capped_blocking(method: str, endpoint: str, headers: dict, payload, timeout: float, cap: int):
+    """requests 回退路径（在线程池中执行）：流式读取响应体，超过 cap 字节立即中止"""
+    kwargs = {}
+    if method.upper() != "GET":
+        if isinstance(payload, bytes):
+            kwargs["data"] = payload
+        else:
+            kwargs["json"] = payload or {}
+    with requests.request(method.upper(), endpoint, headers=headers, timeout=timeout, stream=True,
+                          **kwargs) as response:
+        declared = response.headers.get("Content-Length")
+        if declared and declared.isdigit() and int(declared) > cap:
+            raise ResponseTooLarge(cap, response.status_code)
+        buf = bytearray()
+        for chunk in response.iter_content(65536):
+            buf += chunk
+            if len(buf) > cap:
+                raise ResponseTooLarge(cap, response.status_code)
+    return response, bytes(buf)
+
+
+def _format_bytes(value) -> str:
+    try:
+        n = float(value)
+    except (TypeError, ValueError):
+        return str(value)
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if abs(n) < 1024 or unit == "TB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+
+class ResponseTemplate:
+    """
+    接口回复模板：{attributes.resources.memory_bytes} 形式的占位符在注册关键词时预编译为路径元组，
+    数字段按列表下标取值，* 展开列表（或对象）中的每一项；可加过滤器，如 {attributes.resources.memory_bytes|bytes}。
+    渲染时只取出这些字段，不再把整个响应格式化成 JSON 文本。
+    """
+
+    FILTERS = {"bytes": _format_bytes}
+    _FIELD = re.compile(r"\{([^{}]*)\}")
+
+    __slots__ = ("source", "_parts")
+
+    def __init__(self, source: str):
+        self.source = source
+        parts = []
+        pos = 0
+        for m in self._FIELD.finditer(source):
+            if m.start() > pos:
+                parts.append(source[pos:m.start()])
+            expr, _, flt = m.group(1).partition("|")
+            flt = flt.strip()
+            if flt and flt not in self.FILTERS:
+                raise ValueError(f"未知过滤器 {flt}")
+            segments = expr.strip().split(".")
+            if not expr.strip() or any(not seg for seg in segments):
+                raise ValueError(f"字段路径无效：{{{m.group(1)}}}")
+            path = tuple(int(seg) if seg.isdigit() else seg for seg in segments)
+            parts.append((path, self.FILTERS.get(flt)))
+            pos = m.end()
+        if pos < len(source):
+            parts.append(source[pos:])
+        self._parts = tuple(parts)
+
+    @staticmethod
+    def _resolve(data, path: tuple, i: int = 0) -> list:
+        while i < len(path):
+            seg = path[i]
+            if seg == "*":
+                items = data if isinstance(data, list) else list(data.values()) if isinstance(data, dict) else []
+                out = []
+                for item in items:
+                    out.extend(ResponseTemplate._resolve(item, path, i + 1))
+                return out
+            if isinstance(data, dict):
+                data = data.get(str(seg) if isinstance(seg, int) else seg)
+            elif isinstance(data, list) and isinstance(seg, int):
+                data = data[seg] if -len(data) <= seg < len(data) else None
+            else:
+                return []
+            if data is None:
+                return []
+            i += 1
+        return [data]
+
+    def render(self, data) -> str:
+        out = []
+        for part in self._parts:
+            if isinstance(part, str):
+                out.append(part)
+                continue
+            path, flt = part
+            values = self._resolve(data, path)
+            if not values:
+                out.append("-")
+                continue
+            texts = [flt(v) if flt else (json.dumps(v, ensure_ascii=False) if isinstance(v, (dict, list)) else str(v))
+                     for v in values]
+            out.append(", ".join(texts))
+        return "".join(out)
+
+
+class RetryPolicy:
+    """
+    单个接口关键词的重试与对冲策略（由条目的 retry / hedge 字段编译）：
+    retry = {"attempts": 3, "backoff": 0.2, "max_backoff": 2, "statuses": [502, 503, 504], "post": false}
+    hedge = 0.95 表示 GET 请求耗时超过该接口历史 p95 时再发一个相同请求，取先返回的结果。
+    """
+
+    __slots__ = ("attempts", "backoff", "max_backoff", "statuses", "retry_post", "hedge_quantile")
+
+    DEFAULT_STATUSES = (502, 503, 504)
+
+    def __init__(self, retry, hedge):
+        retry = retry if isinstance(retry, dict) else {}
+        try:
+            self.attempts = max(1, int(retry.get("attempts") or 1))
+        except (TypeError, ValueError):
+            self.attempts = 1
+        try:
+            self.backoff = max(0.0, float(retry.get("backoff", 0.2)))
+            self.max_backoff = max(self.backoff, float(retry.get("max_backoff", 2.0)))
+        except (TypeError, ValueError):
+            self.backoff, self.max_backoff = 0.2, 2.0
+        statuses = retry.get("statuses")
+        try:
+            self.statuses = frozenset(int(c) for c in (statuses if isinstance(statuses, list) else self.DEFAULT_STATUSES))
+        except (TypeError, ValueError):
+            self.statuses = frozenset(self.DEFAULT_STATUSES)
+        # POST 可能有副作用，只有显式声明可安全重复时才重试
+        self.retry_post = retry.get("post") is True
+        if hedge is True:
+            hedge = 0.95
+        try:
+            self.hedge_quantile = float(hedge) if hedge else 0.0
+        except (TypeError, ValueError):
+            self.hedge_quantile = 0.0
+        if not 0 < self.hedge_quantile < 1:
+            self.hedge_quantile = 0.0
+
+    def retryable(self, status) -> bool:
+        """超时/连接错误（无状态码）或配置的状态码可以重试"""
+        return status is None or status in self.statuses
+
+    def delay(self, attempt: int) -> float:
+        """指数退避 + 全抖动：第 n 次重试前等待 [0, min(max_backoff, backoff * 2^(n-1))] 之间的随机时长"""
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** (attempt - 1))))
+
+
+def _edit_distance(a: str, b: str, limit: int) -> int:
+    """Levenshtein 距离；超过 limit 时提前结束并返回 limit + 1"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        if min(cur) > limit:
+            return limit + 1
+        prev = cur
+    return prev[-1]
+
+
+class TypoIndex:
+    """
+    容错匹配用的三元组（trigram）倒排索引。关键词首尾补齐后切成三元组，
+    查询时只对与消息共享足够多三元组的关键词计算编辑距离（q-gram 引理：
+    编辑距离不超过 k 时，共享的三元组数不少于 max(两边三元组数) - 3k），不会遍历整个词库。
+    短关键词在 k 较大时下限可能 ≤ 0（一个三元组都不共享也可能命中），这部分改为按长度分桶直接扫描，
+    因此结果与逐个计算编辑距离完全一致。
+    支持逐个关键词增删，添加/删除回复时无需重建。
+    """
+
+    Q = 3
+
+    __slots__ = ("_postings", "_grams", "_order", "_seq", "_by_length", "max_len")
+
+    def __init__(self, keywords=()):
+        self._postings: dict[str, set] = {}
+        self._grams: dict[str, frozenset] = {}
+        self._order: dict[str, int] = {}
+        self._seq = 0
+        self._by_length: dict[int, set] = {}
+        self.max_len = 0
+        for keyword in keywords:
+            self.add(keyword)
+
+    def __len__(self):
+        return len(self._grams)
+
+    @classmethod
+    def _trigrams(cls, text: str) -> frozenset:
+        padded = "\x02\x02" + text + "\x03\x03"
+        return frozenset(padded[i:i + cls.Q] for i in range(len(padded) - cls.Q + 1))
+
+    def add(self, keyword: str):
+        if keyword in self._grams:
+            return
+        grams = self._trigrams(keyword)
+        self._grams[keyword] = grams
+        self._seq += 1
+        self._order[keyword] = self._seq
+        for g in grams:
+            bucket = self._postings.get(g)
+            if bucket is None:
+                bucket = self._postings[g] = set()
+            bucket.add(keyword)
+        n = len(keyword)
+        same = self._by_length.get(n)
+        if same is None:
+            same = self._by_length[n] = set()
+        same.add(keyword)
+        if n > self.max_len:
+            self.max_len = n
+
+    def remove(self, keyword: str):
+        grams = self._grams.pop(keyword, None)
+        if grams is None:
+            return
+        del self._order[keyword]
+        for g in grams:
+            bucket = self._postings.get(g)
+            if bucket is not None:
+                bucket.discard(keyword)
+                if not bucket:
+                    del self._postings[g]
+        n = len(keyword)
+        same = self._by_length[n]
+        same.discard(keyword)
+        if not same:
+            del self._by_length[n]
+            if n == self.max_len:
+                self.max_len = max(self._by_length, default=0)
+
+    def search(self, text: str, max_distance: int, min_similarity: float):
+        """返回编辑距离最小（相同时先添加者优先）且相似度达标的关键词，没有则返回 None"""
+        if not text or len(text) > self.max_len + max_distance:
+            return None
+        grams = self._trigrams(text)
+        shared: dict[str, int] = {}
+        postings = self._postings
+        for g in grams:
+            bucket = postings.get(g)
+            if bucket:
+                for keyword in bucket:
+                    shared[keyword] = shared.get(keyword, 0) + 1
+        best = None
+        best_keyword = None
+        n = len(text)
+        slack = max_distance * self.Q
+        if len(grams) <= slack:
+            # 长度为 m 的关键词最多 m + 2 个三元组；m + 2 <= 3k 时下限不为正，不共享三元组的也要比较
+            for m in range(max(1, n - max_distance), min(n + max_distance, slack - 2) + 1):
+                for keyword in self._by_length.get(m, ()):
+                    shared.setdefault(keyword, 0)
+        for keyword, count in shared.items():
+            if abs(len(keyword) - n) > max_distance:
+                continue
+            if count < max(len(grams), len(self._grams[keyword])) - slack:
+                continue
+            d = _edit_distance(text, keyword, max_distance)
+            if d > max_distance or 1 - d / max(n, len(keyword)) < min_similarity:
+                continue
+            rank = (d, self._order[keyword])
+            if best is None or rank < best:
+                best, best_keyword = rank, keyword
+        return best_keyword
+
+
+def _result_key(endpoint: str, token, template: "ResponseTemplate | None") -> tuple:
+    """同一接口、令牌与模板的请求结果可以互相替代：响应缓存、轮询快照与熔断兜底都用这个键"""
+    return endpoint, token, template.source if template is not None else None
+
+
+class CommandEntry:
+    """
+    command_map 条目的预编译形式：加载或添加时校验一次，分发路径直接读取字段，
+    不再逐条消息解析原始 dict。原始 dict 仍保存在 command_map 中用于落盘，磁盘格式不变。
+    """
+
+    API_KINDS = ("get_api", "post_api", "multi_api")
+
+    __slots__ = ("keyword", "kind", "reply", "endpoint", "payload", "payload_bytes", "token_index", "token_pool",
+                 "pool_strategy", "code_map", "cache_ttl", "poll_interval", "retry", "template", "result_key",
+                 "coalesce", "cooldown", "targets", "fanout_limit", "fanout_timeout", "error")
+
+    def __init__(self, keyword: str, raw):
+        self.keyword = keyword
+        self.kind = "text"
+        self.reply = ""
+        self.endpoint = ""
+        self.payload = None
+        self.payload_bytes = None
+        self.token_index = None
+        self.token_pool = None
+        self.pool_strategy = "round_robin"
+        self.code_map = {}
+        self.cache_ttl = 0.0
+        self.poll_interval = 0.0
+        self.retry = None
+        self.template = None
+        self.result_key = None
+        self.coalesce = True
+        self.cooldown = 0.0
+        self.targets = ()
+        self.fanout_limit = 0
+        self.fanout_timeout = 0.0
+        self.error = None
+        if isinstance(raw, str):
+            self.reply = raw
+            return
+        if not isinstance(raw, dict) or raw.get("type") not in self.API_KINDS:
+            # 未知类型，回退为文本
+            self.kind = "unknown"
+            self.reply = str(raw)
+            return
+        self.kind = raw["type"]
+        self.coalesce = raw.get("coalesce", True) is not False
+        try:
+            self.cooldown = max(0.0, float(raw.get("cooldown") or 0))
+        except (TypeError, ValueError):
+            self.cooldown = 0.0
+        if self.kind == "multi_api":
+            self._compile_targets(keyword, raw)
+            return
+        self.endpoint = str(raw.get("endpoint") or "")
+        if not self.endpoint.startswith(("http://", "https://")):
+            self.error = f"❌ 关键词 {keyword} 的接口地址无效：{self.endpoint or '（空）'}"
+        if self.kind == "post_api":
+            self.payload = raw.get("payload") or {}
+            self.payload_bytes = json.dumps(self.payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        # 兼容：JSON 会把 code_map 的整型键变成字符串，这里统一恢复为 int
+        cmap = raw.get("code_map")
+        if isinstance(cmap, dict):
+            for kk, vv in cmap.items():
+                try:
+                    self.code_map[int(kk)] = vv
+                except (TypeError, ValueError):
+                    continue
+        try:
+            self.token_index = int(raw["token_index"]) if raw.get("token_index") is not None else None
+        except (TypeError, ValueError):
+            self.token_index = None
+        pool = raw.get("token_pool")
+        if isinstance(pool, list) and pool:
+            try:
+                self.token_pool = tuple(int(i) for i in pool)
+            except (TypeError, ValueError):
+                self.token_pool = None
+        if raw.get("pool_strategy") in TokenLimiter.STRATEGIES:
+            self.pool_strategy = raw["pool_strategy"]
+        try:
+            self.cache_ttl = max(0.0, float(raw.get("cache_ttl") or 0))
+        except (TypeError, ValueError):
+            self.cache_ttl = 0.0
+        if self.kind == "get_api":
+            try:
+                self.poll_interval = max(0.0, float(raw.get("poll_interval") or 0))
+            except (TypeError, ValueError):
+                self.poll_interval = 0.0
+        if raw.get("retry") or raw.get("hedge"):
+            policy = RetryPolicy(raw.get("retry"), raw.get("hedge") if self.kind == "get_api" else None)
+            if policy.attempts > 1 or policy.hedge_quantile:
+                self.retry = policy
+        if raw.get("template"):
+            try:
+                self.template = ResponseTemplate(str(raw["template"]))
+            except ValueError as e:
+                self.error = f"❌ 关键词 {keyword} 的响应模板无效：{e}"
+        # 响应缓存/预热快照的键：同一接口配了不同模板的关键词不能共用结果
+        self.result_key = _result_key(self.endpoint, self.token_pool or self.token_index, self.template)
+
+    def _compile_targets(self, keyword: str, raw: dict):
+        """
+        批量接口：targets 中每一项按 method（默认有 payload 时为 POST，否则 GET）编译为子条目，
+        子条目的 keyword 为目标名称（name，缺省为 #序号），回复时用于标注每个目标的结果。
+        """
+        targets = raw.get("targets")
+        if not isinstance(targets, list) or not targets:
+            self.error = f"❌ 关键词 {keyword} 没有配置任何目标"
+            return
+        compiled = []
+        for i, t in enumerate(targets, 1):
+            if not isinstance(t, dict):
+                self.error = f"❌ 关键词 {keyword} 的第 {i} 个目标格式错误"
+                return
+            method = str(t.get("method") or ("POST" if t.get("payload") is not None else "GET")).upper()
+            sub = dict(t, type="post_api" if method == "POST" else "get_api")
+            sub.setdefault("coalesce", self.coalesce)
+            entry = CommandEntry(str(t.get("name") or f"#{i}"), sub)
+            if entry.error:
+                self.error = entry.error
+                return
+            compiled.append(entry)
+        self.targets = tuple(compiled)
+        try:
+            self.fanout_limit = max(0, int(raw.get("concurrency") or 0))
+        except (TypeError, ValueError):
+            self.fanout_limit = 0
+        try:
+            self.fanout_timeout = max(0.0, float(raw.get("timeout") or 0))
+        except (TypeError, ValueError):
+            self.fanout_timeout = 0.0
+
+
+class ScopeTable:
+    """单个作用域（群/用户）的关键词表；编译条目与模糊匹配索引在该作用域首次被查找时才构建"""
+
+    __slots__ = ("commands", "_entries", "_index")
+
+    def __init__(self, commands: dict):
+        self.commands = commands
+        self._entries = None
+        self._index = None
+
+    def invalidate(self):
+        self._entries = None
+        self._index = None
+
+    def _ensure(self):
+        if self._entries is None:
+            self._entries = {k: CommandEntry(k, v) for k, v in self.commands.items()}
+            self._index = KeywordIndex(self.commands)
+
+    def get(self, msg: str):
+        """精确查找，返回 CommandEntry 或 None"""
+        if msg not in self.commands:
+            return None
+        self._ensure()
+        return self._entries[msg]
+
+    def search(self, msg: str):
+        """模糊查找文本关键词，返回 CommandEntry 或 None"""
+        self._ensure()
+        keyword = self._index.search(msg)
+        return self._entries[keyword] if keyword is not None else None
+
+
+class CooldownTable:
+    """
+    触发冷却表：键 -> 冷却结束时间（monotonic）。
+    OrderedDict 按写入先后排列，查询与写入都是 O(1)；超过上限时淘汰最早写入的记录，
+    这些记录通常早已过期，因此即使有几十万个不同的发送者，内存占用也有上界。
+    """
+
+    __slots__ = ("max_entries", "_until")
+
+    def __init__(self, max_entries: int = 100000):
+        self.max_entries = max(1, int(max_entries))
+        self._until: OrderedDict = OrderedDict()
+
+    def __len__(self):
+        return len(self._until)
+
+    def blocked(self, key, now: float) -> bool:
+        until = self._until.get(key)
+        return until is not None and until > now
+
+    def mark(self, key, seconds: float, now: float):
+        until = self._until
+        until[key] = now + seconds
+        until.move_to_end(key)
+        while len(until) > self.max_entries:
+            until.popitem(last=False)
+
+    def clear(self):
+        self._until.clear()
+
+
+class _PollState:
+    """开启轮询的 GET 关键词的预热状态：最近一次成功结果及下次刷新时间"""
+
+    __slots__ = ("entry", "last_trigger", "next_due", "snapshot", "snapshot_at", "running")
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.last_trigger = 0.0
+        self.next_due = 0.0
+        self.snapshot = None
+        self.snapshot_at = 0.0
+        self.running = False
+
+
+class _Job:
+    __slots__ = ("key", "run", "future", "enqueued_at")
+
+    def __init__(self, key, run, future):
+        self.key = key
+        self.run = run
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class JobQueue:
+    """
+    接口关键词的任务队列：固定数量的 worker 依次执行排队的任务，同时在途的上游请求数不超过 worker 数。
+    容量为 worker 数 + max_depth：空闲 worker 马上就能接手的任务不占排队名额。
+    队列满时按策略处理：reject 直接拒绝；drop_oldest 挤掉最早排队的任务；
+    collapse 让相同关键词的触发共用已在排队的任务，没有可合并的任务时拒绝。
+    """
+
+    POLICIES = ("reject", "drop_oldest", "collapse")
+
+    def __init__(self, workers: int, max_depth: int, policy: str, busy_reply: str):
+        self.workers = max(1, int(workers))
+        self.max_depth = max(1, int(max_depth))
+        self.policy = policy if policy in self.POLICIES else "reject"
+        self.busy_reply = busy_reply
+        self._pending: deque = deque()
+        self._by_key: dict = {}
+        self._ready = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+        self._closing = False
+        self.running = 0
+        self.counts = {"submitted": 0, "completed": 0, "rejected": 0, "dropped": 0, "collapsed": 0}
+        # 排队等待时长（入队到开始执行）
+        self.wait = EndpointStats()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, key, run) -> "asyncio.Future | None":
+        """
+        提交任务，返回结果 Future（结果为回复文本）；被拒绝时返回 None。
+        key 为 None 的任务不参与合并。
+        """
+        if not self._tasks:
+            self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+        self.counts["submitted"] += 1
+        if self.policy == "collapse" and key is not None:
+            job = self._by_key.get(key)
+            if job is not None:
+                self.counts["collapsed"] += 1
+                return job.future
+        # 同一轮事件循环里提交的任务会先进 _pending，再由空闲 worker 取走，所以按执行中 + 排队中计算
+        if self.running + len(self._pending) >= self.workers + self.max_depth:
+            if self.policy != "drop_oldest":
+                self.counts["rejected"] += 1
+                return None
+            oldest = self._pending.popleft()
+            self._forget(oldest)
+            self.counts["dropped"] += 1
+            self.wait.observe(time.monotonic() - oldest.enqueued_at, "dropped")
+            if not oldest.future.done():
+                oldest.future.set_result(self.busy_reply)
+        job = _Job(key, run, asyncio.get_running_loop().create_future())
+        self._pending.append(job)
+        if key is not None:
+            self._by_key[key] = job
+        self._ready.set()
+        return job.future
+
+    def _forget(self, job: _Job):
+        if job.key is not None and self._by_key.get(job.key) is job:
+            del self._by_key[job.key]
+
+    async def _worker(self):
+        pending = self._pending
+        while True:
+            while not pending:
+                if self._closing:
+                    return
+                self._ready.clear()
+                await self._ready.wait()
+            job = pending.popleft()
+            self._forget(job)
+            self.wait.observe(time.monotonic() - job.enqueued_at, "run")
+            self.running += 1
+            try:
+                result = await job.run()
+            except asyncio.CancelledError:
+                if not job.future.done():
+                    job.future.cancel()
+                raise
+            except Exception as e:
+                logger.error(f"队列任务执行失败: {str(e)}")
+                result = f"❌ 调用失败: {str(e)}"
+            finally:
+                self.running -= 1
+            self.counts["completed"] += 1
+            if not job.future.done():
+                job.future.set_result(result)
+
+    def drain(self):
+        """不再接收新任务：worker 执行完已排队的任务后退出（设置变更时替换旧队列用）"""
+        self._closing = True
+        self._ready.set()
+
+    async def close(self):
+        """立即停止：取消 worker 与所有排队任务"""
+        self._closing = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        while self._pending:
+            job = self._pending.popleft()
+            if not job.future.done():
+                job.future.cancel()
+        self._by_key.clear()
+
+
+class ResponseCache:
+    """GET 接口响应的 TTL + LRU 缓存，键为 (endpoint, token_index)，TTL 由各关键词单独指定。"""
+
+    __slots__ = ("max_entries", "hits", "misses", "_data")
+
+    def __init__(self, max_entries: int = 512):
+        self.max_entries = max(1, int(max_entries))
+        self.hits = 0
+        self.misses = 0
+        # key -> (过期时间 monotonic, 响应元组)
+        self._data: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires, value = item
+        if expires <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, ttl: float):
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class _TokenState:
+    __slots__ = ("rate", "burst", "level", "updated", "inflight", "total", "throttled", "rate_limited",
+                 "benched_until")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.level = burst
+        self.updated = time.monotonic()
+        self.inflight = 0
+        self.total = 0
+        self.throttled = 0
+        self.rate_limited = 0
+        self.benched_until = 0.0
+
+
+class TokenLimiter:
+    """
+    多令牌调度：记录每个令牌的用量，按令牌桶限速，收到 429 的令牌暂停一段时间。
+    令牌池（command_map 条目的 token_pool）按 round_robin 或 least_inflight 在可用令牌间分配。
+    """
+
+    STRATEGIES = ("round_robin", "least_inflight")
+
+    def __init__(self, settings: dict):
+        self._states: dict[int, _TokenState] = {}
+        self._cursors: dict[tuple, int] = {}
+        self.configure(settings)
+
+    def configure(self, settings: dict):
+        self.default_rate = float(settings.get("token_rate") or 0)
+        self.default_burst = max(1.0, float(settings.get("token_burst") or 1))
+        self.bench_seconds = float(settings.get("token_bench_seconds") or 0)
+        overrides = settings.get("token_limits") or {}
+        # 手工编辑的设置文件里可能不是对象，按未配置处理；单项无效时由 _limits_for 回落到默认值
+        self.overrides = overrides if isinstance(overrides, dict) else {}
+        for idx, st in self._states.items():
+            st.rate, st.burst = self._limits_for(idx)
+            st.level = min(st.level, st.burst)
+
+    def _limits_for(self, idx: int) -> tuple[float, float]:
+        o = self.overrides.get(str(idx))
+        if isinstance(o, dict):
+            try:
+                return float(o.get("rate", self.default_rate) or 0), max(1.0, float(o.get("burst", self.default_burst)))
+            except (TypeError, ValueError):
+                pass
+        return self.default_rate, self.default_burst
+
+    def state(self, idx: int) -> _TokenState:
+        st = self._states.get(idx)
+        if st is None:
+            st = _TokenState(*self._limits_for(idx))
+            self._states[idx] = st
+        return st
+
+    def reset(self):
+        """令牌列表索引发生变化时清空运行状态"""
+        self._states.clear()
+        self._cursors.clear()
+
+    def _refill(self, st: _TokenState, now: float):
+        if st.rate > 0:
+            st.level = min(st.burst, st.level + (now - st.updated) * st.rate)
+        st.updated = now
+
+    def try_acquire(self, idx: int) -> bool:
+        """从令牌桶取一个配额，不足时记一次限流并返回 False"""
+        st = self.state(idx)
+        if st.rate <= 0:
+            return True
+        self._refill(st, time.monotonic())
+        if st.level >= 1:
+            st.level -= 1
+            return True
+        st.throttled += 1
+        return False
+
+    def pick(self, pool: tuple, token_count: int, strategy: str = "round_robin") -> int | None:
+        """从令牌池中选出一个未暂停且有配额的令牌索引，全部不可用时返回 None"""
+        now = time.monotonic()
+        candidates = [i for i in pool if 0 <= i < token_count and self.state(i).benched_until <= now]
+        if not candidates:
+            return None
+        if strategy == "least_inflight":
+            candidates.sort(key=lambda i: self._states[i].inflight)
+        else:
+            start = self._cursors.get(pool, 0) % len(candidates)
+            candidates = candidates[start:] + candidates[:start]
+            self._cursors[pool] = start + 1
+        for i in candidates:
+            if self.try_acquire(i):
+                return i
+        return None
+
+    def begin(self, idx: int):
+        st = self.state(idx)
+        st.inflight += 1
+        st.total += 1
+
+    def end(self, idx: int, status: int | None):
+        st = self.state(idx)
+        st.inflight -= 1
+        if status == 429:
+            st.rate_limited += 1
+            if self.bench_seconds > 0:
+                st.benched_until = time.monotonic() + self.bench_seconds
+
+    def describe(self, idx: int) -> str:
+        st = self._states.get(idx)
+        if st is None:
+            return "未使用"
+        now = time.monotonic()
+        parts = [f"请求={st.total}", f"进行中={st.inflight}"]
+        if st.rate > 0:
+            self._refill(st, now)
+            parts.append(f"配额={st.level:.1f}/{st.burst:g}@{st.rate:g}/s")
+        if st.throttled:
+            parts.append(f"限流={st.throttled}")
+        if st.rate_limited:
+            parts.append(f"429={st.rate_limited}")
+        if st.benched_until > now:
+            parts.append(f"暂停中(剩余{st.benched_until - now:.0f}s)")
+        return " ".join(parts)
+
+
+class CircuitBreaker:
+    """单个接口主机的熔断器：closed -> open -> half_open -> closed"""
+
+    __slots__ = ("state", "failures", "opened_at", "probes", "trips", "rejected", "last_error")
+
+    def __init__(self):
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes = 0
+        self.trips = 0
+        self.rejected = 0
+        self.last_error = ""
+
+    def allow(self, open_seconds: float, max_probes: int) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < open_seconds:
+                self.rejected += 1
+                return False
+            self.state = "half_open"
+            self.probes = 0
+        if self.probes < max(1, max_probes):
+            self.probes += 1
+            return True
+        self.rejected += 1
+        return False
+
+    def release(self):
+        """探测请求未得出结论（如被取消）时归还名额"""
+        if self.state == "half_open" and self.probes > 0:
+            self.probes -= 1
+
+    def record(self, success: bool, threshold: int, error: str = ""):
+        if success:
+            self.state = "closed"
+            self.failures = 0
+            self.probes = 0
+            return
+        self.failures += 1
+        self.last_error = error
+        if self.state == "half_open" or self.failures >= threshold:
+            if self.state != "open":
+                self.trips += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.probes = 0
+
+
+class EndpointStats:
+    """单个接口的延迟直方图与状态码计数，桶边界固定，记录时不分配新对象"""
+
+    BOUNDS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    __slots__ = ("buckets", "count", "total", "statuses")
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)  # 最后一个桶为 +Inf
+        self.count = 0
+        self.total = 0.0
+        self.statuses: dict = {}
+
+    def observe(self, seconds: float, status):
+        i = 0
+        for bound in self.BOUNDS:
+            if seconds <= bound:
+                break
+            i += 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += seconds
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def quantile(self, q: float) -> float:
+        """按桶上界估算分位数"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                return self.BOUNDS[i] if i < len(self.BOUNDS) else float("inf")
+        return float("inf")
+
+
+class PluginMetrics:
+    """消息处理与接口调用的计数器"""
+
+    __slots__ = ("exact_hits", "fuzzy_hits", "misses", "typo_hits", "whitelist_rejected", "cooldown_suppressed", "keyword_hits",
+                 "endpoints", "retries", "hedges", "hedge_wins", "started_at")
+
+    def __init__(self):
+        self.exact_hits = 0
+        self.fuzzy_hits = 0
+        self.misses = 0
+        self.typo_hits = 0     # 其中由容错匹配命中的次数（计入模糊命中）
+        self.whitelist_rejected = 0
+        # 因冷却被忽略的触发次数，按冷却维度分别计数
+        self.cooldown_suppressed = {"sender": 0, "keyword": 0, "group": 0}
+        self.keyword_hits: dict[str, int] = {}
+        self.endpoints: dict[str, EndpointStats] = {}
+        self.retries = 0       # 重试次数（不含首次请求）
+        self.hedges = 0        # 发出的对冲请求数
+        self.hedge_wins = 0    # 对冲请求先于原请求返回的次数
+        self.started_at = time.time()
+
+    def hit(self, keyword: str, exact: bool):
+        if exact:
+            self.exact_hits += 1
+        else:
+            self.fuzzy_hits += 1
+        self.keyword_hits[keyword] = self.keyword_hits.get(keyword, 0) + 1
+
+    def observe_api(self, endpoint: str, seconds: float, status):
+        stats = self.endpoints.get(endpoint)
+        if stats is None:
+            stats = self.endpoints[endpoint] = EndpointStats()
+        stats.observe(seconds, status)
+
+
+def _prom_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _method_getter(event, name: str):
+    """类上定义的普通方法直接缓存函数本身，调用时不必每次创建绑定方法"""
+    func = getattr(type(event), name, None)
+    if isinstance(func, FunctionType) and name not in getattr(event, "__dict__", ()):
+        return func
+    return methodcaller(name)
+
+
+def _probe_event_text(event):
+    """按优先级探测取文本的方式，返回 (文本, 可按事件类型缓存的取值函数)；都不适用时返回 (None, None)"""
+    # 1) message_str 以及常见的取文本方法/属性
+    for name in ("message_str", "get_message_str", "get_message_text", "get_text", "text"):
+        try:
+            attr = getattr(event, name, None)
+            if callable(attr):
+                v, getter = attr(), _method_getter(event, name)
+            else:
+                v, getter = attr, attrgetter(name)
+            if isinstance(v, str):
+                return v, getter
+        except Exception:
+            continue
+    # 2) event.message 以及其 text 字段
+    try:
+        msg = getattr(event, "message", None)
+        if isinstance(msg, str):
+            return msg, attrgetter("message")
+        if hasattr(msg, "text"):
+            t = msg.text
+            if isinstance(t, str):
+                return t, attrgetter("message.text")
+    except Exception:
+        pass
+    return None, None
+
+
+def _probe_sender_id(event):
+    """按优先级探测取发送者ID的方式，返回 (ID, 可按事件类型缓存的取值函数)；都不适用时返回 (None, None)"""
+    # 优先使用统一方法
+    try:
+        fn = getattr(event, "get_sender_id", None)
+        if callable(fn):
+            return fn(), _method_getter(event, "get_sender_id")
+    except Exception:
+        pass
+    # 常见属性名尝试
+    for name in ("sender_id", "user_id", "uid"):
+        try:
+            v = getattr(event, name, None)
+            if v is not None:
+                return v, attrgetter(name)
+        except Exception:
+            continue
+    # 兼容 sender 对象
+    try:
+        sender = getattr(event, "sender", None)
+        if sender is not None:
+            for n in ("id", "user_id", "uid"):
+                if hasattr(sender, n):
+                    return getattr(sender, n), attrgetter(f"sender.{n}")
+    except Exception:
+        pass
+    return None, None
+
+
+# 批量导入/导出的 CSV 列；payload、code_map、options 列为 JSON 文本
+_CSV_FIELDS = ("keyword", "type", "reply", "endpoint", "token_index", "payload", "code_map", "options")
+
+
+def _parse_import_row(row: dict) -> tuple[str, object]:
+    """校验一行导入数据，返回 (关键词, command_map 中的值)；格式错误抛出 ValueError"""
+    keyword = str(row.get("keyword") or "").strip().lower()
+    if not keyword:
+        raise ValueError("缺少 keyword")
+    kind = str(row.get("type") or "text").strip() or "text"
+    if kind == "text":
+        reply = row.get("reply")
+        if not isinstance(reply, str) or reply == "":
+            raise ValueError("文本回复缺少 reply")
+        return keyword, reply
+    if kind not in CommandEntry.API_KINDS:
+        raise ValueError(f"未知类型 {kind}")
+    if kind == "multi_api":
+        value = {k: v for k, v in row.items() if k not in ("keyword", "reply", "endpoint") and v is not None}
+        entry = CommandEntry(keyword, value)
+        if entry.error:
+            raise ValueError(entry.error.lstrip("❌ "))
+        return keyword, value
+    endpoint = row.get("endpoint")
+    if not isinstance(endpoint, str) or not endpoint.startswith(("http://", "https://")):
+        raise ValueError(f"接口地址无效：{endpoint}")
+    value = {k: v for k, v in row.items() if k not in ("keyword", "reply") and v is not None}
+    value["type"] = kind
+    if "token_index" in value:
+        try:
+            value["token_index"] = int(value["token_index"])
+        except (TypeError, ValueError):
+            raise ValueError(f"token_index 不是整数：{value['token_index']}")
+    if kind == "post_api":
+        payload = value.get("payload")
+        if payload is not None and not isinstance(payload, dict):
+            raise ValueError("payload 必须是 JSON 对象")
+        value.setdefault("payload", None)
+        code_map = value.get("code_map")
+        if code_map is not None:
+            if not isinstance(code_map, dict):
+                raise ValueError("code_map 必须是 JSON 对象")
+            for code, text in code_map.items():
+                try:
+                    int(code)
+                except (TypeError, ValueError):
+                    raise ValueError(f"code_map 的响应代码不是整数：{code}")
+                if not isinstance(text, str):
+                    raise ValueError(f"code_map 中 {code} 的回复不是字符串")
+        value.setdefault("code_map", None)
+    return keyword, value
+
+
+def _iter_import_rows(path: str, fmt: str):
+    """逐行读取导入文件，产出 (行号, dict 或 None, 解析错误)；不会一次性读入整个文件"""
+    if fmt == "csv":
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            for line_no, raw in enumerate(csv.DictReader(f), 2):
+                try:
+                    row = {k: (v if v != "" else None) for k, v in raw.items() if k}
+                    for col in ("payload", "code_map"):
+                        if row.get(col) is not None:
+                            row[col] = json.loads(row[col])
+                    options = row.pop("options", None)
+                    if options is not None:
+                        options = json.loads(options)
+                        if not isinstance(options, dict):
+                            raise ValueError("options 必须是 JSON 对象")
+                        row.update(options)
+                    yield line_no, row, None
+                except Exception as e:
+                    yield line_no, None, str(e)
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+                if not isinstance(row, dict):
+                    raise ValueError("每行必须是 JSON 对象")
+                yield line_no, row, None
+            except Exception as e:
+                yield line_no, None, str(e)
+
+
+def _write_export(path: str, items: list, fmt: str) -> int:
+    """把 (关键词, 值) 列表逐行写出，先写临时文件再替换"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+        if fmt == "csv":
+            writer = csv.writer(f)
+            writer.writerow(_CSV_FIELDS)
+            for k, v in items:
+                if not isinstance(v, dict):
+                    writer.writerow([k, "text", str(v), "", "", "", "", ""])
+                    continue
+                options = {kk: vv for kk, vv in v.items()
+                           if kk not in ("type", "endpoint", "token_index", "payload", "code_map")}
+                writer.writerow([
+                    k, v.get("type", ""), "", v.get("endpoint", ""),
+                    "" if v.get("token_index") is None else v["token_index"],
+                    "" if v.get("payload") is None else json.dumps(v["payload"], ensure_ascii=False),
+                    "" if v.get("code_map") is None else json.dumps(v["code_map"], ensure_ascii=False),
+                    json.dumps(options, ensure_ascii=False) if options else "",
+                ])
+        else:
+            for k, v in items:
+                row = {"keyword": k, **v} if isinstance(v, dict) else {"keyword": k, "reply": v}
+                f.write(json.dumps(row, ensure_ascii=False))
+                f.write("\n")
+    os.replace(tmp_path, path)
+    return len(items)
+
+
+def _read_json_file(path: str):
+    """读取 JSON 文件；文件不存在或内容为空时返回 None，内容损坏时抛出异常"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+    except FileNotFoundError:
+        return None
+    if not text.strip():
+        return None
+    return json.loads(text)
+
+
+def _atomic_write_text(path: str, text: str):
+    """
+    先写临时文件再 os.replace，避免写到一半崩溃导致文件损坏。
+    临时文件名唯一（同目录 mkstemp），即使有两个写入同时进行也不会写到同一个临时文件里。
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with open(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class WriteBehind:
+    """
+    JSON 文件的延迟合并写入：修改只标记为脏，窗口期结束后在线程池中原子写入最新内容，
+    同一文件在窗口内的多次修改只落盘一次。插件卸载时调用 close() 立即写完。
+    flush 之间用锁串行，同一文件不会有两个写入同时进行，后写入的内容总是最后落盘。
+    """
+
+    def __init__(self, delay: float = 1.0, on_write=None):
+        self.delay = max(0.0, float(delay))
+        self.on_write = on_write
+        self.requests = 0
+        self.writes = 0
+        # path -> (生成文件内容的函数, 日志中的名称)
+        self._dirty: dict[str, tuple] = {}
+        self._task: asyncio.Task | None = None
+        # 后台任务仍在等待合并窗口（尚未开始写入）时才允许 close() 取消它
+        self._sleeping = False
+        self._lock = asyncio.Lock()
+
+    def mark(self, path: str, render, label: str):
+        self.requests += 1
+        self._dirty[path] = (render, label)
+        if self._task is not None:
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # 没有事件循环（如初始化阶段）时直接同步写入
+            self.flush_sync()
+            return
+        self._sleeping = True
+        self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        try:
+            if self.delay > 0:
+                await asyncio.sleep(self.delay)
+            self._sleeping = False
+            await self.flush()
+        finally:
+            self._sleeping = False
+            self._task = None
+
+    async def flush(self):
+        async with self._lock:
+            while self._dirty:
+                path, (render, label) = self._dirty.popitem()
+                try:
+                    # 在事件循环线程中序列化快照，线程池只负责写盘
+                    text = render()
+                    write = asyncio.ensure_future(asyncio.to_thread(_atomic_write_text, path, text))
+                    try:
+                        await asyncio.shield(write)
+                    except asyncio.CancelledError:
+                        # 线程无法中断：等它写完再放开锁，避免与下一次 flush 的写入交错
+                        await asyncio.gather(write, return_exceptions=True)
+                        raise
+                    self.writes += 1
+                    if self.on_write is not None:
+                        self.on_write(path)
+                except Exception as e:
+                    logger.error(f"{label}保存失败: {str(e)}")
+
+    def flush_sync(self):
+        while self._dirty:
+            path, (render, label) = self._dirty.popitem()
+            try:
+                _atomic_write_text(path, render())
+                self.writes += 1
+                if self.on_write is not None:
+                    self.on_write(path)
+            except Exception as e:
+                logger.error(f"{label}保存失败: {str(e)}")
+
+    def is_dirty(self, path: str) -> bool:
+        return path in self._dirty
+
+    async def close(self):
+        task = self._task
+        if task is not None:
+            # 还在等待窗口时直接取消；已经开始写入则等它写完，不打断线程池中的写盘
+            if self._sleeping:
+                task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        await self.flush()
+
+
+class SqliteStore:
+    """
+    SQLite（WAL）存储后端：关键词、白名单、令牌分表保存，单条增删只写一行，
+    不再整文件重写。首次启用时从旧版 JSON 文件一次性迁移。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS commands (
+                keyword TEXT PRIMARY KEY,
+                value   TEXT NOT NULL,
+                seq     INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS commands_seq ON commands(seq);
+            CREATE TABLE IF NOT EXISTS whitelist (id TEXT PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS tokens (idx INTEGER PRIMARY KEY, token TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS scoped_commands (
+                scope   TEXT NOT NULL,
+                keyword TEXT NOT NULL,
+                value   TEXT NOT NULL,
+                seq     INTEGER NOT NULL,
+                PRIMARY KEY (scope, keyword)
+            );
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            """
+        )
+
+    def close(self):
+        self.conn.close()
+
+    def data_version(self) -> int:
+        """其他连接（外部工具）提交修改后该值会变化，本连接自己的写入不会改变它"""
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def is_migrated(self) -> bool:
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'migrated'").fetchone()
+        return row is not None
+
+    def migrate(self, command_map: dict, whitelist: set, tokens: list, scoped: dict | None = None):
+        """把旧版 JSON 中的数据一次性写入数据库（单个事务）"""
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO commands (keyword, value, seq) VALUES (?, ?, ?)",
+                [(k, json.dumps(v, ensure_ascii=False), i) for i, (k, v) in enumerate(command_map.items(), 1)],
+            )
+            for scope, commands in (scoped or {}).items():
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO scoped_commands (scope, keyword, value, seq) VALUES (?, ?, ?, ?)",
+                    [(scope, k, json.dumps(v, ensure_ascii=False), i) for i, (k, v) in enumerate(commands.items(), 1)],
+                )
+            self.conn.executemany("INSERT OR IGNORE INTO whitelist (id) VALUES (?)", [(x,) for x in whitelist])
+            self.conn.execute("DELETE FROM tokens")
+            self.conn.executemany("INSERT INTO tokens (idx, token) VALUES (?, ?)", list(enumerate(tokens)))
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated', ?)",
+                              (str(int(time.time())),))
+
+    def load_commands(self) -> dict:
+        rows = self.conn.execute("SELECT keyword, value FROM commands ORDER BY seq")
+        return {k: json.loads(v) for k, v in rows}
+
+    def put_command(self, keyword: str, value):
+        # 已存在的关键词保持原有顺序，与 dict 覆盖赋值的语义一致
+        self.conn.execute(
+            "INSERT INTO commands (keyword, value, seq) "
+            "VALUES (?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM commands)) "
+            "ON CONFLICT(keyword) DO UPDATE SET value = excluded.value",
+            (keyword, json.dumps(value, ensure_ascii=False)),
+        )
+
+    def put_commands(self, items: list, replace: bool = False):
+        """批量写入关键词（单个事务）；replace 为 True 时先清空原有词库"""
+        with self.conn:
+            self.conn.execute("BEGIN")
+            if replace:
+                self.conn.execute("DELETE FROM commands")
+            for keyword, value in items:
+                self.put_command(keyword, value)
+
+    def delete_command(self, keyword: str):
+        self.conn.execute("DELETE FROM commands WHERE keyword = ?", (keyword,))
+
+    def load_scoped(self) -> dict:
+        scoped: dict[str, dict] = {}
+        rows = self.conn.execute("SELECT scope, keyword, value FROM scoped_commands ORDER BY scope, seq")
+        for scope, k, v in rows:
+            scoped.setdefault(scope, {})[k] = json.loads(v)
+        return scoped
+
+    def put_scoped(self, scope: str, keyword: str, value):
+        self.conn.execute(
+            "INSERT INTO scoped_commands (scope, keyword, value, seq) "
+            "VALUES (?, ?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM scoped_commands WHERE scope = ?)) "
+            "ON CONFLICT(scope, keyword) DO UPDATE SET value = excluded.value",
+            (scope, keyword, json.dumps(value, ensure_ascii=False), scope),
+        )
+
+    def delete_scoped(self, scope: str, keyword: str):
+        self.conn.execute("DELETE FROM scoped_commands WHERE scope = ? AND keyword = ?", (scope, keyword))
+
+    def load_whitelist(self) -> set:
+        return {row[0] for row in self.conn.execute("SELECT id FROM whitelist")}
+
+    def add_whitelist(self, uid: str):
+        self.conn.execute("INSERT OR IGNORE INTO whitelist (id) VALUES (?)", (uid,))
+
+    def remove_whitelist(self, uid: str):
+        self.conn.execute("DELETE FROM whitelist WHERE id = ?", (uid,))
+
+    def load_tokens(self) -> list[str]:
+        return [row[0] for row in self.conn.execute("SELECT token FROM tokens ORDER BY idx")]
+
+    def save_tokens(self, tokens: list):
+        # 令牌列表很短且删除会导致索引整体前移，直接整表替换
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.execute("DELETE FROM tokens")
+            self.conn.executemany("INSERT INTO tokens (idx, token) VALUES (?, ?)", list(enumerate(tokens)))
+
+
 @register("自定义回复插件", "Varrge", "关键词回复插件", "1.1.0", "https://github.com/KiritoLifeF/AstrBot_CustomCommand")
 class CustomCommandPlugin(Star):
     def __init__(self, context: Context):
@@ -23,54 +1507,717 @@ class CustomCommandPlugin(Star):
         # 修复：手动创建插件数据目录
         plugin_data_dir = os.path.join("data", "plugins", "astrbot_plugin_custom_command")
         os.makedirs(plugin_data_dir, exist_ok=True)
+        self.plugin_data_dir = plugin_data_dir
         self.config_path = os.path.join(plugin_data_dir, "custom_command_config.json")
+        self.whitelist_path = os.path.join(plugin_data_dir, "whitelist.json")
+        self.tokens_path = os.path.join(plugin_data_dir, "api_tokens.json")
+        self.scoped_path = os.path.join(plugin_data_dir, "scoped_commands.json")
+        self.db_path = os.path.join(plugin_data_dir, "custom_command.db")
+        # 插件设置（决定存储后端，需最先加载）
+        self.settings_path = os.path.join(plugin_data_dir, "plugin_settings.json")
+        self.settings = self._load_settings()
+        self._apply_log_settings()
+        self.persister = WriteBehind(self.settings["persist_delay"], on_write=self._remember_file_sig)
+        self.store = self._open_store()
+
         self.command_map = self._load_config()
+        # 词库版本号：每次变更递增，用于让列表渲染缓存失效
+        self._map_version = 0
+        self._listing_version = -1
+        self._listing_keys: dict[tuple, list] = {}
+        self._listing_lines: dict[tuple, str] = {}
+        # 容错匹配索引，开启 typo_match 时才构建
+        self.typo_index = None
+        self._rebuild_index()
+        self._apply_typo_settings()
+        # 群/用户作用域的关键词表："group:<群号>" / "user:<用户ID>" -> ScopeTable
+        self.scopes = {name: ScopeTable(m) for name, m in self._load_scoped().items()}
         self.api_token = self._load_token()
-        logger.info(f"配置文件路径：{self.config_path}")
+        logger.info(f"配置文件路径：{self.db_path if self.store else self.config_path}")
         # 白名单配置
-        self.plugin_data_dir = os.path.join("data", "plugins", "astrbot_plugin_custom_command")
-        self.whitelist_path = os.path.join(self.plugin_data_dir, "whitelist.json")
         self.whitelist_enabled = True  # 默认开启白名单策略
         self.whitelist = self._load_whitelist()
+        # 白名单/令牌的本地修改计数，热重载据此判断读取期间是否有新修改
+        self._whitelist_version = 0
+        self._tokens_version = 0
         # 新增：多令牌支持
-        self.tokens_path = os.path.join(plugin_data_dir, "api_tokens.json")
         self.token_list = self._load_tokens()
+        # 共享 HTTP 客户端（长连接池），插件卸载时关闭
+        self._host_slots: dict[str, asyncio.Semaphore] = {}
+        self.http_client = self._create_http_client()
+        # get_api 响应缓存（仅对设置了 cache_ttl 的关键词生效）
+        self.response_cache = ResponseCache(self.settings["cache_max_entries"])
+        # 单飞合并：相同请求并发时共享同一个上游调用
+        self._inflight: dict[tuple, asyncio.Future] = {}
+        self.coalesced_requests = 0
+        # 令牌用量、限速与 429 暂停
+        self.token_limiter = TokenLimiter(self.settings)
+        # 按接口主机熔断；GET 接口按 result_key 记录最近一次成功结果，用于熔断期间兜底
+        self.breakers: dict[str, CircuitBreaker] = {}
+        self._last_good: dict[tuple, tuple[float, tuple]] = {}
+        # 外部修改检测：记录已加载文件的 (mtime, size)，后台轮询发现变化时只重载变化的文件
+        self._file_sigs: dict[str, tuple | None] = {}
+        for path in (self.config_path, self.whitelist_path, self.tokens_path, self.scoped_path):
+            self._remember_file_sig(path)
+        self._db_version = self.store.data_version() if self.store is not None else None
+        # 按事件类型缓存的取文本/取发送者方式
+        self._text_getters: dict[type, object] = {}
+        self._sender_getters: dict[type, object] = {}
+        # 运行指标
+        self.metrics = PluginMetrics()
+        # 触发冷却
+        self.cooldowns = CooldownTable(self.settings["cooldown_max_tracked"])
+        self._apply_cooldown_settings()
+        # 接口关键词任务队列（queue_workers 为 0 时不启用）
+        self.job_queue = self._create_job_queue()
+        self._deliveries: set[asyncio.Task] = set()
+        # GET 关键词预热轮询：(endpoint, 令牌) -> _PollState，只包含最近被触发过的关键词
+        self._polls: dict[tuple, _PollState] = {}
+        # 词库中仍开启轮询的条目：result_key -> CommandEntry，按 _map_version 重新计算
+        self._live_polls: dict[tuple, CommandEntry] = {}
+        self._live_polls_version = -1
+        self._poll_tasks: set[asyncio.Task] = set()
+        self._background_tasks: list[asyncio.Task] = []
+        self._start_background_tasks()
 
-    def _load_config(self) -> dict:
-        """加载本地配置文件，并修正 JSON 导致的 key 类型问题（如 code_map 的整型被转成字符串）。"""
+    def _start_background_tasks(self):
+        """启动后台任务；初始化时若没有运行中的事件循环，则在收到第一条消息时再启动"""
+        if self._background_tasks:
+            return
         try:
-            if not os.path.exists(self.config_path):
-                return {}
-            with open(self.config_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._background_tasks.append(asyncio.ensure_future(self._watch_files()))
+        self._background_tasks.append(asyncio.ensure_future(self._dump_metrics_loop()))
+        self._background_tasks.append(asyncio.ensure_future(self._poll_loop()))
 
-            # 兼容：把 post_api 的 code_map 的键从 str 恢复为 int
-            if isinstance(data, dict):
-                for _, v in data.items():
-                    if isinstance(v, dict) and v.get("type") == "post_api":
-                        cmap = v.get("code_map")
-                        if isinstance(cmap, dict):
-                            fixed = {}
-                            for kk, vv in cmap.items():
-                                try:
-                                    fixed[int(kk)] = vv
-                                except Exception:
-                                    # 无法转为 int 的键保持原样
-                                    fixed[kk] = vv
-                            v["code_map"] = fixed
+    async def terminate(self):
+        """插件卸载/停用时写完待保存的文件，释放连接池与数据库连接"""
+        for task in self._background_tasks:
+            task.cancel()
+        await asyncio.gather(*self._background_tasks, return_exceptions=True)
+        self._background_tasks = []
+        if self.job_queue is not None:
+            await self.job_queue.close()
+        for task in list(self._deliveries) + list(self._poll_tasks):
+            task.cancel()
+        await asyncio.gather(*self._deliveries, *self._poll_tasks, return_exceptions=True)
+        await self.persister.close()
+        await self._close_http_client(self.http_client)
+        self.http_client = None
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+    def _open_store(self):
+        """storage_backend 为 sqlite 时打开数据库，首次启用从 JSON 文件迁移；失败则回退到 JSON"""
+        if self.settings.get("storage_backend") != "sqlite":
+            return None
+        try:
+            store = SqliteStore(self.db_path)
+            if not store.is_migrated():
+                self.store = None
+                command_map = self._load_config()
+                whitelist = self._load_whitelist()
+                self.api_token = self._load_token()
+                tokens = self._load_tokens()
+                store.migrate(command_map, whitelist, tokens, self._load_scoped())
+                logger.info(f"已从 JSON 迁移到 SQLite：{len(command_map)} 个关键词，"
+                            f"{len(whitelist)} 个白名单，{len(tokens)} 个令牌")
+            return store
+        except Exception as e:
+            logger.error(f"SQLite 存储打开失败，回退到 JSON: {str(e)}")
+            return None
+
+    def _load_settings(self) -> dict:
+        """加载插件设置，缺失项使用默认值"""
+        settings = dict(DEFAULT_SETTINGS)
+        try:
+            if os.path.exists(self.settings_path):
+                with open(self.settings_path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if isinstance(data, dict):
+                    for k, v in data.items():
+                        if k in DEFAULT_SETTINGS and not _setting_type_ok(k, v):
+                            logger.error(f"插件设置 {k} 的值类型无效，使用默认值: {json.dumps(v, ensure_ascii=False)}")
+                            continue
+                        settings[k] = v
+        except Exception as e:
+            logger.error(f"插件设置加载失败: {str(e)}")
+        return settings
+
+    def _save_settings(self):
+        """保存插件设置（只写入与默认值不同的项）"""
+        try:
+            data = {k: v for k, v in self.settings.items() if DEFAULT_SETTINGS.get(k) != v}
+            with open(self.settings_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            logger.error(f"插件设置保存失败: {str(e)}")
+
+    def _apply_log_settings(self):
+        """根据设置切换日志级别；逐条消息的调试日志只在开启时按采样比例输出"""
+        self._trace = bool(self.settings.get("debug_log"))
+        try:
+            self._trace_rate = min(1.0, max(0.0, float(self.settings.get("debug_sample_rate", 1.0))))
+        except (TypeError, ValueError):
+            self._trace_rate = 1.0
+        logger.setLevel(logging.DEBUG if self._trace else logging.INFO)
+
+    def _apply_cooldown_settings(self):
+        """读取冷却设置；全部为 0 时消息路径只做一次布尔判断"""
+        def seconds(key):
+            try:
+                return max(0.0, float(self.settings.get(key) or 0))
+            except (TypeError, ValueError):
+                return 0.0
+        self._cooldown_sender = seconds("cooldown_sender")
+        self._cooldown_keyword = seconds("cooldown_keyword")
+        self._cooldown_group = seconds("cooldown_group")
+        self._cooldown_api_only = bool(self.settings.get("cooldown_api_only"))
+        self._cooldown_on = bool(self._cooldown_sender or self._cooldown_keyword or self._cooldown_group)
+        try:
+            self.cooldowns.max_entries = max(1, int(self.settings.get("cooldown_max_tracked") or 1))
+        except (TypeError, ValueError):
+            pass
+
+    def _cooldown_blocked(self, event, entry: CommandEntry) -> bool:
+        """
+        检查发送者/关键词/群三个维度的冷却。任一维度仍在冷却中则忽略本次触发；
+        全部通过时才同时记下新的冷却时间，被忽略的触发不会延长冷却。
+        """
+        if self._cooldown_api_only and entry.kind not in CommandEntry.API_KINDS:
+            return False
+        checks = []
+        if self._cooldown_sender:
+            sid = self._get_sender_id(event)
+            if sid is not None:
+                checks.append(("sender", ("s", str(sid)), self._cooldown_sender))
+        keyword_seconds = entry.cooldown or self._cooldown_keyword
+        if keyword_seconds:
+            checks.append(("keyword", ("k", entry.keyword), keyword_seconds))
+        if self._cooldown_group:
+            gid = self._get_group_id(event)
+            if gid:
+                checks.append(("group", ("g", gid), self._cooldown_group))
+        if not checks:
+            return False
+        now = time.monotonic()
+        table = self.cooldowns
+        for kind, key, _ in checks:
+            if table.blocked(key, now):
+                self.metrics.cooldown_suppressed[kind] += 1
+                return True
+        for _, key, secs in checks:
+            table.mark(key, secs, now)
+        return False
+
+    def _create_job_queue(self):
+        try:
+            workers = int(self.settings.get("queue_workers") or 0)
+        except (TypeError, ValueError):
+            workers = 0
+        if workers <= 0:
+            return None
+        return JobQueue(workers, self.settings["queue_max_depth"], self.settings["queue_policy"],
+                        self.settings["queue_busy_reply"])
+
+    async def _run_api_entry(self, entry: CommandEntry) -> str:
+        """执行接口关键词并返回回复文本"""
+        if entry.kind == "multi_api":
+            return await self._run_fanout(entry)
+        if entry.kind == "get_api":
+            ok, out, status = await self._call_get_entry(entry)
+            if ok and entry.poll_interval:
+                self._store_snapshot(entry, (ok, out, status))
+            return out
+        ok, out, status = await self._call_post_entry(entry)
+        reply = entry.code_map.get(status) if status is not None else None
+        return reply if reply is not None else out
+
+    async def _run_fanout(self, entry: CommandEntry) -> str:
+        """并发请求批量接口的所有目标（受并发上限与单目标超时约束），汇总为一条回复"""
+        limit = entry.fanout_limit or max(1, int(self.settings["fanout_concurrency"]))
+        timeout = entry.fanout_timeout or float(self.settings["fanout_timeout"])
+        sem = asyncio.Semaphore(limit)
+
+        async def one(target: CommandEntry):
+            async with sem:
+                try:
+                    if target.kind == "get_api":
+                        call = self._call_get_entry(target)
+                    else:
+                        call = self._call_post_entry(target)
+                    ok, out, status = await asyncio.wait_for(call, timeout) if timeout > 0 else await call
+                except asyncio.TimeoutError:
+                    return False, f"⏱ 超时（{timeout:g} 秒）"
+                except Exception as e:
+                    return False, f"❌ {str(e)}"
+            mapped = target.code_map.get(status) if status is not None else None
+            if mapped is not None:
+                return ok, mapped
+            if ok:
+                return ok, out if target.template is not None else f"✅ 成功（{status}）"
+            return ok, out.splitlines()[0] if out else "❌ 失败"
+
+        results = await asyncio.gather(*(one(t) for t in entry.targets))
+        succeeded = sum(1 for ok, _ in results if ok)
+        lines = [f"{entry.keyword}：{succeeded}/{len(results)} 个目标成功"]
+        lines.extend(f"{t.keyword}：{text}" for t, (_ok, text) in zip(entry.targets, results))
+        return "\n".join(lines)
+
+    def _snapshot_reply(self, entry: CommandEntry) -> str | None:
+        """
+        开启轮询的 GET 关键词被触发：登记触发时间（让后台继续轮询），
+        有足够新的快照时直接返回快照与其时效，否则返回 None 走实时请求。
+        """
+        key = entry.result_key
+        state = self._polls.get(key)
+        now = time.monotonic()
+        if state is None:
+            # 首次触发走实时请求并写入快照，后台从下一个周期开始刷新
+            state = self._polls[key] = _PollState(entry)
+            state.next_due = now + self._poll_delay(entry.poll_interval)
+        state.entry = entry
+        state.last_trigger = now
+        if state.snapshot is None:
+            return None
+        age = now - state.snapshot_at
+        # 超过两个轮询周期仍未刷新（例如刚从暂停中恢复），视为过期
+        if age > entry.poll_interval * 2:
+            return None
+        return f"{state.snapshot[1]}\nℹ️ 数据更新于 {age:.0f} 秒前"
+
+    def _store_snapshot(self, entry: CommandEntry, result: tuple):
+        key = entry.result_key
+        state = self._polls.get(key)
+        if state is None:
+            state = self._polls[key] = _PollState(entry)
+            state.last_trigger = time.monotonic()
+        state.snapshot = result
+        state.snapshot_at = time.monotonic()
+        state.next_due = state.snapshot_at + self._poll_delay(entry.poll_interval)
+
+    def _poll_delay(self, interval: float) -> float:
+        try:
+            jitter = min(1.0, max(0.0, float(self.settings.get("poll_jitter") or 0)))
+        except (TypeError, ValueError):
+            jitter = 0.0
+        return interval * (1 + random.uniform(-jitter, jitter))
+
+    def _polling_entries(self) -> dict:
+        """词库（含各作用域）中仍开启轮询的 GET 条目，按 result_key 索引；词库变更后才重新计算"""
+        if self._live_polls_version != self._map_version:
+            live = {}
+            for e in self.entries.values():
+                if e.poll_interval:
+                    live.setdefault(e.result_key, e)
+            for table in self.scopes.values():
+                for k, v in table.commands.items():
+                    if isinstance(v, dict) and v.get("poll_interval"):
+                        e = CommandEntry(k, v)
+                        if e.poll_interval:
+                            live.setdefault(e.result_key, e)
+            self._live_polls, self._live_polls_version = live, self._map_version
+        return self._live_polls
+
+    async def _poll_loop(self):
+        """
+        后台刷新被触发过的轮询关键词；超过 poll_idle_seconds 无人触发，
+        或关键词已被删除/关闭轮询的，移出轮询。
+        """
+        while True:
+            now = time.monotonic()
+            idle = float(self.settings.get("poll_idle_seconds") or 0)
+            wake = now + 1.0
+            live = self._polling_entries()
+            for key, state in list(self._polls.items()):
+                entry = live.get(key)
+                if entry is None or (idle > 0 and now - state.last_trigger > idle):
+                    del self._polls[key]
+                    continue
+                # 轮询间隔等配置可能已修改，总是按词库中的最新条目刷新
+                state.entry = entry
+                if state.running:
+                    continue
+                if state.next_due <= now:
+                    state.running = True
+                    task = asyncio.ensure_future(self._refresh_poll(state))
+                    self._poll_tasks.add(task)
+                    task.add_done_callback(self._poll_tasks.discard)
+                else:
+                    wake = min(wake, state.next_due)
+            await asyncio.sleep(max(0.05, wake - time.monotonic()))
+
+    async def _refresh_poll(self, state: _PollState):
+        e = state.entry
+        try:
+            result = await self._coalesced_request("GET", e.endpoint, token_index=e.token_index, coalesce=e.coalesce,
+                                                   token_pool=e.token_pool, pool_strategy=e.pool_strategy,
+                                                   policy=e.retry, template=e.template)
+            if result[0]:
+                state.snapshot = result
+                state.snapshot_at = time.monotonic()
+            elif self._trace:
+                logger.debug("轮询 %s 失败: %s", e.keyword, result[1])
+        except Exception as ex:
+            logger.error(f"轮询 {e.keyword} 失败: {str(ex)}")
+        finally:
+            # 失败时保留旧快照，按正常间隔重试
+            state.next_due = time.monotonic() + self._poll_delay(e.poll_interval)
+            state.running = False
+
+    async def _deliver_later(self, umo: str, future: asyncio.Future):
+        """确认模式：等待排队任务完成后主动发送结果"""
+        try:
+            text = await future
+        except asyncio.CancelledError:
+            return
+        try:
+            await self.context.send_message(umo, MessageChain().message(text))
+        except Exception as e:
+            logger.error(f"发送排队任务结果失败: {str(e)}")
+
+    def _create_http_client(self):
+        """创建共享的异步 HTTP 客户端：keep-alive 连接池，可用时启用 HTTP/2"""
+        if httpx is None:
+            logger.info("未安装 httpx，API 请求将在线程池中使用 requests 执行")
+            return None
+        limits = httpx.Limits(
+            max_connections=int(self.settings["http_max_connections"]),
+            max_keepalive_connections=int(self.settings["http_max_keepalive"]),
+        )
+        return httpx.AsyncClient(
+            limits=limits,
+            timeout=float(self.settings["http_timeout"]),
+            http2=HTTP2_AVAILABLE,
+            # 与原先 requests 的默认行为保持一致：自动跟随重定向
+            follow_redirects=True,
+        )
+
+    async def _close_http_client(self, client):
+        if client is None:
+            return
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.error(f"HTTP 客户端关闭失败: {str(e)}")
+
+    def _host_slot(self, endpoint: str) -> asyncio.Semaphore:
+        """按主机限制并发请求数，避免单个面板占满连接池"""
+        host = urlsplit(endpoint).netloc
+        slot = self._host_slots.get(host)
+        if slot is None:
+            slot = asyncio.Semaphore(max(1, int(self.settings["http_max_per_host"])))
+            self._host_slots[host] = slot
+        return slot
+
+    @staticmethod
+    def _file_sig(path: str) -> tuple | None:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _remember_file_sig(self, path: str):
+        self._file_sigs[path] = self._file_sig(path)
+
+    async def _watch_files(self):
+        """后台轮询文件的 mtime/size（SQLite 则看 data_version），发现外部修改后重载"""
+        while True:
+            interval = float(self.settings.get("reload_interval") or 0)
+            await asyncio.sleep(interval if interval > 0 else 5.0)
+            if interval <= 0:
+                continue
+            try:
+                await self._reload_changed()
+            except Exception as e:
+                logger.error(f"热重载失败: {str(e)}")
+
+    def _changed_sources(self) -> set[str]:
+        if self.store is not None:
+            version = self.store.data_version()
+            if version == self._db_version:
+                return set()
+            self._db_version = version
+            return {"config", "whitelist", "tokens", "scoped"}
+        changed = set()
+        for name, path in (("config", self.config_path), ("whitelist", self.whitelist_path),
+                           ("tokens", self.tokens_path), ("scoped", self.scoped_path)):
+            # 本插件尚未落盘的修改优先，不被外部内容覆盖
+            if self.persister.is_dirty(path):
+                continue
+            sig = self._file_sig(path)
+            if sig != self._file_sigs.get(path):
+                self._file_sigs[path] = sig
+                changed.add(name)
+        return changed
+
+    def _retry_reload(self, path: str):
+        """清掉变更标记，下个轮询周期重新加载该文件（SQLite 则整体重新加载）"""
+        if self.store is not None:
+            self._db_version = None
+        else:
+            self._file_sigs.pop(path, None)
+
+    def _edited_during_reload(self, path: str, version: int, current: int) -> bool:
+        """
+        读取期间本地有新修改（版本号变化或仍有未落盘的写入）时放弃这次重载结果，
+        避免用旧内容覆盖刚做的修改；下个轮询周期会按落盘后的内容重新加载。
+        """
+        if version == current and not self.persister.is_dirty(path):
+            return False
+        self._retry_reload(path)
+        logger.info(f"重载期间检测到本地修改，跳过本次重载：{os.path.basename(path)}")
+        return True
+
+    async def _reload_read(self, path: str, label: str, func, *args):
+        """
+        在线程池中读取一个数据源；读取或解析失败（例如外部工具写到一半）时保留当前内容，
+        记录错误并返回 None，下个轮询周期重试。
+        """
+        try:
+            return await asyncio.to_thread(func, *args)
+        except Exception as e:
+            logger.error(f"{label}重载失败，保留当前内容，稍后重试: {str(e)}")
+            self._retry_reload(path)
+            return None
+
+    async def _reload_changed(self, force: bool = False) -> set[str]:
+        """
+        重载发生变化的文件。读取、解析和重建索引都在线程池中完成，
+        最后在事件循环中一次性替换，消息处理不会看到加载到一半的词库。
+        """
+        changed = {"config", "whitelist", "tokens", "scoped"} if force else self._changed_sources()
+        if not changed:
+            return changed
+        if "config" in changed:
+            version = self._map_version
+            state = await self._reload_read(self.config_path, "词库", self._build_config_state,
+                                            self.typo_index is not None)
+            if state is None or self._edited_during_reload(self.config_path, version, self._map_version):
+                changed.discard("config")
+            else:
+                # 四个结构在同一步里替换，消息处理不会看到新词库配旧索引的中间状态
+                self.command_map, self.entries, self.keyword_index, self.typo_index = state
+                self._map_version += 1
+                # 重载期间可能切换过容错匹配开关，按当前设置补建或丢弃容错索引
+                self._apply_typo_settings()
+        if "scoped" in changed:
+            version = self._map_version
+            scoped = await self._reload_read(self.scoped_path, "作用域词库", self._load_scoped, True)
+            if scoped is None or self._edited_during_reload(self.scoped_path, version, self._map_version):
+                changed.discard("scoped")
+            else:
+                self.scopes = {name: ScopeTable(m) for name, m in scoped.items()}
+                self._map_version += 1
+        if "whitelist" in changed:
+            version = self._whitelist_version
+            whitelist = await self._reload_read(self.whitelist_path, "白名单", self._load_whitelist, True)
+            if whitelist is None or self._edited_during_reload(self.whitelist_path, version, self._whitelist_version):
+                changed.discard("whitelist")
+            else:
+                self.whitelist = whitelist
+        if "tokens" in changed:
+            version = self._tokens_version
+            tokens = await self._reload_read(self.tokens_path, "API令牌列表", self._load_tokens, True)
+            if tokens is None or self._edited_during_reload(self.tokens_path, version, self._tokens_version):
+                changed.discard("tokens")
+            elif tokens != self.token_list:
+                self.token_list = tokens
+                self.token_limiter.reset()
+        if not changed:
+            return changed
+        logger.info(f"已重载：{'、'.join(sorted(changed))}")
+        return changed
+
+    def _load_config(self, strict: bool = False) -> dict:
+        """
+        加载本地配置文件（code_map 的字符串键在编译 CommandEntry 时恢复为 int）。
+        strict 为 True（热重载）时解析失败直接抛出，由调用方保留当前词库；文件不存在或为空才视为空词库。
+        """
+        try:
+            if self.store is not None:
+                data = self.store.load_commands()
+            else:
+                data = _read_json_file(self.config_path)
+                if data is None:
+                    return {}
+            if not isinstance(data, dict):
+                raise ValueError("顶层不是 JSON 对象")
             return data
         except Exception as e:
+            if strict:
+                raise
             logger.error(f"配置加载失败: {str(e)}")
             return {}
 
-    def _save_config(self, data: dict):
-        """保存配置到文件"""
+    @staticmethod
+    def _compile_entries(command_map: dict) -> dict:
+        """把整个词库编译为 CommandEntry（可在线程池中执行）"""
+        return {k: CommandEntry(k, v) for k, v in command_map.items()}
+
+    def _build_index(self, command_map: dict) -> KeywordIndex:
+        """根据词库构建模糊匹配自动机（可在线程池中执行）"""
+        return KeywordIndex(command_map)
+
+    def _build_config_state(self, with_typo: bool) -> tuple:
+        """读取配置并编译条目、模糊匹配自动机与容错索引（在线程池中一次完成）；文件损坏时抛出"""
+        command_map = self._load_config(strict=True)
+        return (
+            command_map,
+            self._compile_entries(command_map),
+            self._build_index(command_map),
+            self._build_typo_index(command_map) if with_typo else None,
+        )
+
+    def _rebuild_index(self):
+        """command_map 整体变更后重新编译条目并重建模糊匹配自动机与容错匹配索引"""
+        self._map_version += 1
+        self.entries = self._compile_entries(self.command_map)
+        self.keyword_index = self._build_index(self.command_map)
+        if self.typo_index is not None:
+            self.typo_index = self._build_typo_index(self.command_map)
+
+    def _refresh_fuzzy_index(self):
+        """单个关键词增删后只重建子串匹配自动机；条目与容错索引由 _commit_command/_remove_command 逐个更新"""
+        self.keyword_index = self._build_index(self.command_map)
+
+    @staticmethod
+    def _typo_eligible(value) -> bool:
+        """只有文本与 GET 关键词参与容错匹配，避免打错字误触有副作用的 POST/批量接口"""
+        return isinstance(value, str) or (isinstance(value, dict) and value.get("type") == "get_api")
+
+    @classmethod
+    def _build_typo_index(cls, command_map: dict) -> TypoIndex:
+        return TypoIndex(k for k, v in command_map.items() if cls._typo_eligible(v))
+
+    def _apply_typo_settings(self):
         try:
-            with open(self.config_path, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            self._typo_distance = max(1, int(self.settings.get("typo_max_distance") or 1))
+            self._typo_similarity = min(1.0, max(0.0, float(self.settings.get("typo_min_similarity") or 0)))
+        except (TypeError, ValueError):
+            self._typo_distance, self._typo_similarity = 1, 0.6
+        if not self.settings.get("typo_match"):
+            self.typo_index = None
+        elif self.typo_index is None:
+            self.typo_index = self._build_typo_index(self.command_map)
+
+    def _commit_command(self, key: str):
+        """关键词新增或修改后重新编译该条目并持久化：SQLite 只写这一行，JSON 则整文件保存"""
+        self.entries[key] = CommandEntry(key, self.command_map[key])
+        self._map_version += 1
+        if self.typo_index is not None:
+            if self._typo_eligible(self.command_map[key]):
+                self.typo_index.add(key)
+            else:
+                self.typo_index.remove(key)
+        if self.store is None:
+            self._save_config(self.command_map)
+            return
+        try:
+            self.store.put_command(key, self.command_map[key])
+        except Exception as e:
+            logger.error(f"配置保存失败: {str(e)}")
+
+    def _remove_command(self, key: str):
+        """删除单个关键词的编译条目与持久化记录"""
+        self.entries.pop(key, None)
+        self._map_version += 1
+        if self.typo_index is not None:
+            self.typo_index.remove(key)
+        if self.store is None:
+            self._save_config(self.command_map)
+            return
+        try:
+            self.store.delete_command(key)
         except Exception as e:
             logger.error(f"配置保存失败: {str(e)}")
 
+    def _load_scoped(self, strict: bool = False) -> dict:
+        """加载群/用户作用域的关键词：{作用域: {关键词: 值}}；strict 同 _load_config"""
+        try:
+            if self.store is not None:
+                return self.store.load_scoped()
+            data = _read_json_file(self.scoped_path)
+            if data is None:
+                return {}
+            if not isinstance(data, dict):
+                raise ValueError("顶层不是 JSON 对象")
+            return {str(k): v for k, v in data.items() if isinstance(v, dict)}
+        except Exception as e:
+            if strict:
+                raise
+            logger.error(f"作用域词库加载失败: {str(e)}")
+            return {}
+
+    def _persist_scoped(self, scope: str, key: str):
+        """持久化作用域内单个关键词的新增/修改/删除"""
+        table = self.scopes.get(scope)
+        if table is not None:
+            table.invalidate()
+        self._map_version += 1
+        if self.store is None:
+            self.persister.mark(
+                self.scoped_path,
+                lambda: json.dumps({n: t.commands for n, t in self.scopes.items()}, ensure_ascii=False, indent=2),
+                "作用域词库",
+            )
+            return
+        try:
+            if table is not None and key in table.commands:
+                self.store.put_scoped(scope, key, table.commands[key])
+            else:
+                self.store.delete_scoped(scope, key)
+        except Exception as e:
+            logger.error(f"作用域词库保存失败: {str(e)}")
+
+    def _get_group_id(self, event) -> str:
+        """取群号，私聊返回空字符串"""
+        fn = getattr(event, "get_group_id", None)
+        try:
+            gid = fn() if callable(fn) else getattr(event, "group_id", None)
+        except Exception:
+            gid = None
+        return str(gid) if gid else ""
+
+    @staticmethod
+    def _is_scope_token(raw: str) -> bool:
+        """参数是否写成了作用域（不论能否解析），用于在位置不固定的参数中识别作用域"""
+        if raw in ("全局", "global", "本群", "group", "我", "me", "user"):
+            return True
+        kind, sep, _ = raw.replace("：", ":").partition(":")
+        return bool(sep) and kind.strip().lower() in ("群", "用户", "group", "user")
+
+    def _parse_scope(self, event, raw: str) -> str | None:
+        """
+        解析命令中的作用域参数：
+        空/全局 -> ""；本群 -> 当前群；我 -> 当前发送者；群:123 / 用户:456（也可写 group:/user:）
+        无法解析时返回 None
+        """
+        raw = str(raw or "").strip()
+        if raw in ("", "全局", "global"):
+            return ""
+        if raw in ("本群", "group"):
+            gid = self._get_group_id(event)
+            return f"group:{gid}" if gid else None
+        if raw in ("我", "me", "user"):
+            sid = self._get_sender_id(event)
+            return f"user:{sid}" if sid is not None else None
+        kind, sep, ident = raw.replace("：", ":").partition(":")
+        if not sep or not ident.strip():
+            return None
+        kind = {"群": "group", "用户": "user"}.get(kind.strip(), kind.strip().lower())
+        if kind not in ("group", "user"):
+            return None
+        return f"{kind}:{ident.strip()}"
+
+    def _save_config(self, data: dict):
+        """保存配置到文件（延迟合并、原子写入）"""
+        self.persister.mark(self.config_path, lambda: json.dumps(data, ensure_ascii=False, indent=2), "配置")
+
     def _load_token(self) -> str:
         """加载API令牌"""
         token_path = os.path.join("data", "plugins", "astrbot_plugin_custom_command", "api_token.json")
@@ -97,13 +2244,16 @@ class CustomCommandPlugin(Star):
         except Exception as e:
             logger.error(f"API令牌保存失败: {str(e)}")
 
-    def _load_tokens(self) -> list[str]:
-        """加载API令牌列表，兼容旧版单令牌文件"""
+    def _load_tokens(self, strict: bool = False) -> list[str]:
+        """加载API令牌列表，兼容旧版单令牌文件；strict 同 _load_config"""
         try:
+            if self.store is not None:
+                return self.store.load_tokens()
             # 优先读取新文件
             if os.path.exists(self.tokens_path):
-                with open(self.tokens_path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
+                data = _read_json_file(self.tokens_path)
+                if data is None:
+                    return []
                 lst = data.get("tokens", [])
                 return [str(x) for x in lst if str(x).strip() != ""]
 
@@ -118,41 +2268,65 @@ class CustomCommandPlugin(Star):
                 return [tok] if tok else []
             return []
         except Exception as e:
+            if strict:
+                raise
             logger.error(f"API令牌列表加载失败: {str(e)}")
             return []
 
     def _save_tokens(self):
-        """保存API令牌列表到新文件"""
+        """保存API令牌列表到新文件（或数据库）"""
+        self._tokens_version += 1
         try:
-            os.makedirs(os.path.dirname(self.tokens_path), exist_ok=True)
-            with open(self.tokens_path, "w", encoding="utf-8") as f:
-                json.dump({"tokens": self.token_list}, f, ensure_ascii=False, indent=2)
-            logger.info("API令牌列表保存成功")
+            if self.store is not None:
+                self.store.save_tokens(self.token_list)
+                logger.info("API令牌列表保存成功")
+                return
+            self.persister.mark(
+                self.tokens_path,
+                lambda: json.dumps({"tokens": self.token_list}, ensure_ascii=False, indent=2),
+                "API令牌列表",
+            )
         except Exception as e:
             logger.error(f"API令牌列表保存失败: {str(e)}")
 
-    def _load_whitelist(self) -> set:
-        """加载白名单，存为字符串集合"""
+    def _load_whitelist(self, strict: bool = False) -> set:
+        """加载白名单，存为字符串集合；strict 同 _load_config"""
         try:
-            if not os.path.exists(self.whitelist_path):
+            if self.store is not None:
+                return self.store.load_whitelist()
+            data = _read_json_file(self.whitelist_path)
+            if data is None:
                 return set()
-            with open(self.whitelist_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                # 存为字符串集合，避免类型不一致
-                return set(str(x) for x in data.get("ids", []))
+            # 存为字符串集合，避免类型不一致
+            return set(str(x) for x in data.get("ids", []))
         except Exception as e:
+            if strict:
+                raise
             logger.error(f"白名单加载失败: {str(e)}")
             return set()
 
-    def _save_whitelist(self):
-        """保存白名单到文件"""
+    def _persist_whitelist(self, uid: str, added: bool):
+        """持久化单个白名单变更：SQLite 只写这一行，JSON 则整文件保存"""
+        self._whitelist_version += 1
+        if self.store is None:
+            self._save_whitelist()
+            return
         try:
-            os.makedirs(self.plugin_data_dir, exist_ok=True)
-            with open(self.whitelist_path, "w", encoding="utf-8") as f:
-                json.dump({"ids": sorted(self.whitelist)}, f, ensure_ascii=False, indent=2)
+            if added:
+                self.store.add_whitelist(uid)
+            else:
+                self.store.remove_whitelist(uid)
         except Exception as e:
             logger.error(f"白名单保存失败: {str(e)}")
 
+    def _save_whitelist(self):
+        """保存白名单到文件（延迟合并、原子写入）"""
+        self.persister.mark(
+            self.whitelist_path,
+            lambda: json.dumps({"ids": sorted(self.whitelist)}, ensure_ascii=False, indent=2),
+            "白名单",
+        )
+
     def _parse_list_input(self, raw: str) -> list:
         """
         将用户传入的“数组”解析为列表。
@@ -190,98 +2364,476 @@ class CustomCommandPlugin(Star):
         except Exception:
             return v
 
-    def _request_api(self, method: str, endpoint: str, payload: dict | None = None, token_index: int | None = None):
-        """统一的HTTP请求方法，支持按索引选择令牌。返回 (ok: bool, message: str, status_code: int|None)"""
-        # 选择令牌：优先使用传入索引；否则回退到列表的第0个；再回退到旧版 self.api_token
-        token_to_use = None
+    def _resolve_token_index(self, token_index) -> int | None:
+        """解析令牌索引：优先使用传入索引；否则回退到列表的第0个；列表为空返回 None（使用旧版 self.api_token）"""
+        try:
+            if token_index is not None:
+                if isinstance(token_index, str):
+                    token_index = int(token_index)
+                if 0 <= token_index < len(self.token_list):
+                    return token_index
+        except Exception:
+            pass
+        if getattr(self, "token_list", None):
+            return 0
+        return None
+
+    async def _request_api(self, method: str, endpoint: str, payload: dict | bytes | None = None, token_index: int | None = None,
+                           token_pool: tuple | None = None, pool_strategy: str = "round_robin",
+                           policy: RetryPolicy | None = None, template: ResponseTemplate | None = None):
+        """
+        统一的异步HTTP请求方法，支持按索引选择令牌，或从令牌池（token_pool）中按策略调度。
+        policy 为关键词的重试/对冲策略，熔断检查与令牌选择只做一次，每次尝试都计入延迟统计；
+        template 为关键词的回复模板，成功时只格式化模板中的字段。
+        返回 (ok: bool, message: str, status_code: int|None)
+        """
+        threshold = int(self.settings["breaker_failure_threshold"])
+        breaker = None
+        if threshold > 0:
+            host = urlsplit(endpoint).netloc
+            breaker = self.breakers.get(host)
+            if breaker is None:
+                breaker = self.breakers[host] = CircuitBreaker()
+            if not breaker.allow(float(self.settings["breaker_open_seconds"]),
+                                 int(self.settings["breaker_half_open_probes"])):
+                return self._breaker_fallback(method, _result_key(endpoint, token_pool or token_index, template))
+
+        idx, token_to_use, error = self._pick_token(token_index, token_pool, pool_strategy)
+        if error:
+            # 令牌不可用与接口主机无关，不计入熔断
+            if breaker is not None:
+                breaker.release()
+            return False, error, None
+
+        if idx is not None:
+            self.token_limiter.begin(idx)
+        status = None
+        try:
+            if policy is None:
+                result = await self._timed_send(method, endpoint, payload, token_to_use, template)
+            else:
+                result = await self._send_with_policy(method, endpoint, payload, token_to_use, policy,
+                                                      breaker, threshold, template)
+            status = result[2]
+        except BaseException:
+            if breaker is not None:
+                breaker.release()
+            raise
+        finally:
+            if idx is not None:
+                self.token_limiter.end(idx, status)
+        ok, message, status = result
+        if breaker is not None:
+            if ok or (status is not None and status < 500):
+                # 4xx 说明主机可达，不计入熔断
+                breaker.record(True, threshold)
+            else:
+                breaker.record(False, threshold, message.splitlines()[0])
+        if ok and method.upper() == "GET":
+            # 与关键词的 result_key 一致：同一接口配了不同模板/令牌的关键词各自保留兜底结果
+            key = _result_key(endpoint, token_pool or token_index, template)
+            self._last_good[key] = (time.monotonic(), result)
+        return result
+
+    async def _timed_send(self, method: str, endpoint: str, payload, token_to_use: str, template=None):
+        started = time.perf_counter()
+        result = await self._send_request(method, endpoint, payload, token_to_use, template)
+        self.metrics.observe_api(endpoint, time.perf_counter() - started, result[2])
+        return result
+
+    async def _send_with_policy(self, method: str, endpoint: str, payload, token_to_use: str, policy: RetryPolicy,
+                                breaker: CircuitBreaker | None, threshold: int, template=None):
+        """按策略重试：只重试超时/连接错误与配置的状态码，失败的尝试计入熔断，熔断打开后不再重试"""
+        is_get = method.upper() == "GET"
+        attempts = policy.attempts if (is_get or policy.retry_post) else 1
+        hedge = policy.hedge_quantile if is_get else 0.0
+        attempt = 1
+        while True:
+            if hedge:
+                result = await self._hedged_send(endpoint, token_to_use, hedge, template)
+            else:
+                result = await self._timed_send(method, endpoint, payload, token_to_use, template)
+            ok, message, status = result
+            if ok or attempt >= attempts or not policy.retryable(status):
+                return result
+            if breaker is not None and (status is None or status >= 500):
+                breaker.record(False, threshold, message.splitlines()[0])
+                if breaker.state == "open":
+                    return result
+            self.metrics.retries += 1
+            if self._trace:
+                logger.debug("%s %s 第 %d 次请求失败（%s），准备重试", method.upper(), endpoint, attempt, status)
+            await asyncio.sleep(policy.delay(attempt))
+            attempt += 1
+
+    async def _hedged_send(self, endpoint: str, token_to_use: str, quantile: float, template=None):
+        """
+        对冲 GET：等待时间超过该接口历史耗时的指定分位数仍未返回时，再发一个相同请求，取先成功的结果。
+        样本不足（少于 20 次）时不对冲。
+        """
+        stats = self.metrics.endpoints.get(endpoint)
+        delay = stats.quantile(quantile) if stats is not None and stats.count >= 20 else float("inf")
+        first = asyncio.ensure_future(self._timed_send("GET", endpoint, None, token_to_use, template))
+        if delay == float("inf"):
+            return await first
+        tasks = {first}
         try:
-            if token_index is not None:
-                if isinstance(token_index, str):
-                    token_index = int(token_index)
-                if 0 <= token_index < len(self.token_list):
-                    token_to_use = self.token_list[token_index]
-        except Exception:
-            pass
-        if token_to_use is None and getattr(self, "token_list", None):
-            if len(self.token_list) > 0:
-                token_to_use = self.token_list[0]
-        if token_to_use is None:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done:
+                return first.result()
+            self.metrics.hedges += 1
+            second = asyncio.ensure_future(self._timed_send("GET", endpoint, None, token_to_use, template))
+            tasks.add(second)
+            while True:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    tasks.discard(task)
+                    result = task.result()
+                    # 先返回的是失败结果而另一个还在进行时，继续等另一个
+                    if result[0] or not tasks:
+                        if task is second:
+                            self.metrics.hedge_wins += 1
+                        return result
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _breaker_fallback(self, method: str, key: tuple):
+        """
+        熔断期间的快速回复：GET 接口优先返回同一 result_key 最近一次成功结果。
+        兜底结果一律以失败返回（ok=False、无状态码），响应缓存、轮询快照与 _last_good 都不会把旧结果当作新结果保存。
+        """
+        if method.upper() == "GET":
+            item = self._last_good.get(key)
+            if item is not None:
+                at, (_ok, message, _status) = item
+                return False, f"⚠️ 接口暂时不可用，以下为 {time.monotonic() - at:.0f} 秒前的结果：\n{message}", None
+        return False, str(self.settings["breaker_reply"]), None
+
+    def _pick_token(self, token_index, token_pool: tuple | None, pool_strategy: str):
+        """选出本次请求使用的令牌（限速/令牌池），返回 (索引或 None, 令牌, 错误信息或 None)"""
+        if token_pool:
+            idx = self.token_limiter.pick(token_pool, len(self.token_list), pool_strategy)
+            if idx is None:
+                return None, None, "❌ 令牌池中的令牌均已限流或暂停，请稍后再试"
+        else:
+            idx = self._resolve_token_index(token_index)
+            if idx is not None and not self.token_limiter.try_acquire(idx):
+                return None, None, f"❌ 令牌 {idx} 已达到速率上限，请稍后再试"
+        if idx is not None:
+            token_to_use = self.token_list[idx]
+        else:
             token_to_use = self.api_token if getattr(self, "api_token", "") else None
 
         if not token_to_use:
-            return False, "❌ API令牌未设置，请先使用“/tokenAdd”添加令牌（或 /设置API令牌 兼容旧版）。", None
+            return None, None, "❌ API令牌未设置，请先使用“/tokenAdd”添加令牌（或 /设置API令牌 兼容旧版）。"
+        return idx, token_to_use, None
 
+    async def _send_request(self, method: str, endpoint: str, payload: dict | bytes | None, token_to_use: str,
+                            template: ResponseTemplate | None = None):
+        """
+        使用指定令牌发出请求并格式化结果；payload 可以是预先序列化好的 JSON 字节。
+        响应体按流读取，超过 http_max_body_bytes 立即中止；有模板时只渲染模板中的字段。
+        """
         headers = {
             "Authorization": f"Bearer {token_to_use}",
             'Accept': 'Application/vnd.pterodactyl.v1+json',
             'Content-Type': 'application/json'
         }
+        is_get = method.upper() == "GET"
+        cap = max(1, int(self.settings["http_max_body_bytes"]))
+        body = b""
         try:
-            if method.upper() == "GET":
-                response = requests.get(endpoint, headers=headers, timeout=10)
-            else:
-                response = requests.post(endpoint, headers=headers, json=(payload or {}), timeout=10)
+            async with self._host_slot(endpoint):
+                if self.http_client is not None:
+                    kwargs = {}
+                    if not is_get:
+                        if isinstance(payload, bytes):
+                            kwargs["content"] = payload
+                        else:
+                            kwargs["json"] = payload or {}
+                    async with self.http_client.stream(method.upper(), endpoint, headers=headers, **kwargs) as response:
+                        body = await self._read_capped(response, cap)
+                else:
+                    timeout = float(self.settings["http_timeout"])
+                    response, body = await asyncio.to_thread(_read_capped_blocking, method, endpoint, headers,
+                                                             payload, timeout, cap)
             response.raise_for_status()
-            try:
-                result = response.json()
-                return True, f"API响应（JSON）：\n{json.dumps(result, ensure_ascii=False, indent=2)}", response.status_code
-            except Exception:
-                return True, f"API响应（文本）：\n{response.text}", response.status_code
-        except requests.HTTPError as e:
+            return True, self._format_body(body, response, template), response.status_code
+        except _HTTP_STATUS_ERRORS as e:
             status = getattr(e.response, 'status_code', None)
-            text = None
-            try:
-                text = e.response.text if e.response is not None else None
-            except Exception:
-                pass
+            text = self._decode_body(body, e.response) if body else None
             msg = f"❌ 调用{method.upper()} API失败: {str(e)}"
             if text:
-                msg += f"\n响应体：\n{text}"
+                msg += f"\n响应体：\n{self._truncate(text)}"
             return False, msg, status
+        except ResponseTooLarge as e:
+            # 带上实际状态码：不会被当作超时/连接错误重试，也不计入熔断失败
+            return False, f"❌ 调用{method.upper()} API失败: {str(e)}", e.status
         except Exception as e:
             return False, f"❌ 调用{method.upper()} API失败: {str(e)}", None
 
+    @staticmethod
+    async def _read_capped(response, cap: int) -> bytes:
+        declared = response.headers.get("content-length")
+        if declared and declared.isdigit() and int(declared) > cap:
+            raise ResponseTooLarge(cap, response.status_code)
+        buf = bytearray()
+        async for chunk in response.aiter_bytes():
+            buf += chunk
+            if len(buf) > cap:
+                raise ResponseTooLarge(cap, response.status_code)
+        return bytes(buf)
+
+    @staticmethod
+    def _decode_body(body: bytes, response) -> str:
+        try:
+            return body.decode(getattr(response, "encoding", None) or "utf-8", errors="replace")
+        except LookupError:
+            return body.decode("utf-8", errors="replace")
+
+    def _truncate(self, text: str) -> str:
+        limit = int(self.settings["reply_max_chars"])
+        if limit <= 0 or len(text) <= limit:
+            return text
+        return f"{text[:limit]}\n…（已截断，共 {len(text)} 个字符）"
+
+    def _format_body(self, body: bytes, response, template: ResponseTemplate | None) -> str:
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return f"API响应（文本）：\n{self._truncate(self._decode_body(body, response))}"
+        if template is not None:
+            return template.render(data)
+        return f"API响应（JSON）：\n{self._truncate(json.dumps(data, ensure_ascii=False, indent=2))}"
+
     @command("添加自定义回复")
     @permission_type(PermissionType.ADMIN)
-    async def add_reply(self, event: AstrMessageEvent, keyword: str, reply: str):
-        """/添加自定义回复 关键字 内容"""
-        self.command_map[keyword.strip().lower()] = reply
-        self._save_config(self.command_map)
+    async def add_reply(self, event: AstrMessageEvent, keyword: str, reply: str, scope: str = ""):
+        """/添加自定义回复 关键字 内容 [作用域：全局|本群|我|群:群号|用户:ID]"""
+        key = keyword.strip().lower()
+        scope_name = self._parse_scope(event, scope)
+        if scope_name is None:
+            yield event.plain_result(f"❌ 无法识别的作用域：{scope}")
+            return
+        if scope_name:
+            table = self.scopes.get(scope_name)
+            if table is None:
+                table = self.scopes[scope_name] = ScopeTable({})
+            table.commands[key] = reply
+            self._persist_scoped(scope_name, key)
+            yield event.plain_result(f"✅ 已添加关键词回复（{scope_name}）： [{keyword}] -> {reply}")
+            return
+        self.command_map[key] = reply
+        self._refresh_fuzzy_index()
+        self._commit_command(key)
         yield event.plain_result(f"✅ 已添加关键词回复： [{keyword}] -> {reply}")
 
     @command("查看自定义回复")
-    async def list_replies(self, event: AstrMessageEvent):
-        """查看所有关键词回复"""
-        if not self.command_map:
-            yield event.plain_result("暂无自定义回复")
+    async def list_replies(self, event: AstrMessageEvent, page: str = "1", keyword_filter: str = "", scope: str = ""):
+        """/查看自定义回复 [页码] [过滤词] [作用域] —— 分页查看关键词回复，过滤词匹配关键词中的任意部分"""
+        args = [str(a).strip() for a in (page, keyword_filter, scope)]
+        if not args[2]:
+            # 作用域可以写在任意位置：/查看自定义回复 本群、/查看自定义回复 服务器 本群
+            for i, a in enumerate(args[:2]):
+                if self._is_scope_token(a):
+                    args[2], args[i] = a, ""
+                    break
+        scope = args[2]
+        scope_name = self._parse_scope(event, scope)
+        if scope_name is None:
+            yield event.plain_result(f"❌ 无法识别的作用域：{scope}")
             return
-        lines = []
-        for i, (k, v) in enumerate(self.command_map.items()):
-            if isinstance(v, dict):
-                if v.get("type") == "get_api":
-                    lines.append(f"{i + 1}. [GET] {k} -> {v.get('endpoint', '')} (token_idx={v.get('token_index', 0)})")
-                elif v.get("type") == "post_api":
-                    ep = v.get('endpoint', '')
-                    payload = v.get('payload', {})
-                    lines.append(
-                        f"{i + 1}. [POST] {k} -> {ep}  payload={json.dumps(payload, ensure_ascii=False)} (token_idx={v.get('token_index', 0)})")
-                else:
-                    lines.append(f"{i + 1}. [未知类型] {k} -> {v}")
-            else:
-                lines.append(f"{i+1}. [文本] {k} -> {v}")
-        msg = "当前关键词回复列表：\n" + "\n".join(lines)
+        if not self._scope_commands(scope_name):
+            yield event.plain_result(f"{scope_name} 暂无自定义回复" if scope_name else "暂无自定义回复")
+            return
+        rest = [a for a in args[:2] if a]
+        # 第一个参数不是数字时视为只给了过滤词：/查看自定义回复 服务器
+        page = rest.pop(0) if rest and rest[0].isdecimal() else "1"
+        keyword_filter = rest[0].lower() if rest else ""
+        keys = self._listing_keys_for(keyword_filter, scope_name)
+        if not keys:
+            yield event.plain_result(f"没有包含“{keyword_filter}”的关键词")
+            return
+        size = max(1, int(self.settings["list_page_size"]))
+        pages = (len(keys) + size - 1) // size
+        n = min(max(1, int(page or 1)), pages)
+        start = (n - 1) * size
+        lines = [f"{i}. {self._listing_line(k, scope_name)}" for i, k in enumerate(keys[start:start + size], start + 1)]
+        title = f"{scope_name} " if scope_name else "当前"
+        title += f"关键词回复列表（第 {n}/{pages} 页，共 {len(keys)} 条"
+        title += f"，过滤：{keyword_filter}）" if keyword_filter else "）"
+        msg = title + "：\n" + "\n".join(lines)
+        if pages > 1:
+            msg += "\n使用 /查看自定义回复 页码 [过滤词] 翻页"
         yield event.plain_result(msg)
 
+    def _scope_commands(self, scope_name: str) -> dict:
+        if not scope_name:
+            return self.command_map
+        table = self.scopes.get(scope_name)
+        return table.commands if table is not None else {}
+
+    def _listing_keys_for(self, keyword_filter: str, scope_name: str = "") -> list:
+        """按作用域与过滤词取关键词列表；结果与渲染好的行都缓存到词库下次变更为止"""
+        if self._listing_version != self._map_version:
+            self._listing_version = self._map_version
+            self._listing_keys = {}
+            self._listing_lines = {}
+        commands = self._scope_commands(scope_name)
+        cache_key = (scope_name, keyword_filter)
+        keys = self._listing_keys.get(cache_key)
+        if keys is None:
+            if keyword_filter or scope_name:
+                keys = [k for k in commands if keyword_filter in k]
+                if len(self._listing_keys) >= 16:
+                    # 过滤结果只保留少量，避免被大量不同的过滤词撑大
+                    self._listing_keys.pop(next(iter(self._listing_keys)))
+            else:
+                keys = list(commands)
+            self._listing_keys[cache_key] = keys
+        return keys
+
+    def _listing_line(self, k: str, scope_name: str = "") -> str:
+        line = self._listing_lines.get((scope_name, k))
+        if line is not None:
+            return line
+        v = self._scope_commands(scope_name).get(k)
+        if isinstance(v, dict):
+            if v.get("type") == "get_api":
+                line = f"[GET] {k} -> {v.get('endpoint', '')} (token_idx={v.get('token_index', 0)})"
+            elif v.get("type") == "multi_api":
+                names = [str(t.get("name") or t.get("endpoint", "")) for t in v.get("targets") or [] if isinstance(t, dict)]
+                line = f"[批量] {k} -> {len(names)} 个目标：{', '.join(names[:5])}{' …' if len(names) > 5 else ''}"
+            elif v.get("type") == "post_api":
+                ep = v.get('endpoint', '')
+                payload = v.get('payload', {})
+                line = f"[POST] {k} -> {ep}  payload={json.dumps(payload, ensure_ascii=False)} (token_idx={v.get('token_index', 0)})"
+            else:
+                line = f"[未知类型] {k} -> {v}"
+        else:
+            line = f"[文本] {k} -> {v}"
+        self._listing_lines[(scope_name, k)] = line
+        return line
+
+    def _data_file(self, name: str) -> str | None:
+        """把命令中给出的文件名解析到插件数据目录内，越界路径返回 None"""
+        base = os.path.abspath(self.plugin_data_dir)
+        path = os.path.abspath(os.path.join(base, str(name).strip()))
+        if not path.startswith(base + os.sep):
+            return None
+        return path
+
+    @staticmethod
+    def _bulk_format(name: str, fmt: str) -> str | None:
+        fmt = str(fmt).strip().lower()
+        if not fmt:
+            fmt = "csv" if name.lower().endswith(".csv") else "jsonl"
+        return fmt if fmt in ("jsonl", "csv") else None
+
+    def _read_import(self, path: str, fmt: str) -> tuple[dict, list, int]:
+        """在线程池中流式解析并逐行校验，返回 (有效条目, 错误列表, 总行数)"""
+        items: dict = {}
+        errors: list[str] = []
+        total = 0
+        for line_no, row, err in _iter_import_rows(path, fmt):
+            total += 1
+            if err is None:
+                try:
+                    key, value = _parse_import_row(row)
+                    items[key] = value
+                    continue
+                except ValueError as e:
+                    err = str(e)
+            errors.append(f"第 {line_no} 行：{err}")
+        return items, errors, total
+
+    @command("导入词库")
+    @permission_type(PermissionType.ADMIN)
+    async def import_replies(self, event: AstrMessageEvent, file_name: str, fmt: str = "", mode: str = "合并"):
+        """/导入词库 文件名 [jsonl|csv] [合并|覆盖] —— 从插件数据目录批量导入关键词，一次落盘、一次重建索引"""
+        path = self._data_file(file_name)
+        if path is None:
+            yield event.plain_result("❌ 文件必须位于插件数据目录内")
+            return
+        fmt = self._bulk_format(file_name, fmt)
+        if fmt is None:
+            yield event.plain_result("❌ 格式仅支持：jsonl/csv")
+            return
+        if not os.path.exists(path):
+            yield event.plain_result(f"❌ 文件不存在：{path}")
+            return
+        replace = str(mode).strip() in ("覆盖", "replace")
+        try:
+            items, errors, total = await asyncio.to_thread(self._read_import, path, fmt)
+        except Exception as e:
+            yield event.plain_result(f"❌ 导入失败: {str(e)}")
+            return
+        if items:
+            if replace:
+                self.command_map = {}
+            self.command_map.update(items)
+            if self.store is not None:
+                try:
+                    await asyncio.to_thread(self.store.put_commands, list(items.items()), replace)
+                except Exception as e:
+                    logger.error(f"配置保存失败: {str(e)}")
+            else:
+                self._save_config(self.command_map)
+            self._rebuild_index()
+        lines = [f"✅ 导入完成：共 {total} 行，成功 {len(items)} 条，失败 {len(errors)} 条"
+                 + ("（已覆盖原词库）" if replace and items else "")]
+        if errors:
+            lines.extend(errors[:20])
+            if len(errors) > 20:
+                lines.append(f"……其余 {len(errors) - 20} 条错误未显示")
+        yield event.plain_result("\n".join(lines))
+
+    @command("导出词库")
+    @permission_type(PermissionType.ADMIN)
+    async def export_replies(self, event: AstrMessageEvent, file_name: str, fmt: str = ""):
+        """/导出词库 文件名 [jsonl|csv] —— 把词库导出到插件数据目录"""
+        path = self._data_file(file_name)
+        if path is None:
+            yield event.plain_result("❌ 文件必须位于插件数据目录内")
+            return
+        fmt = self._bulk_format(file_name, fmt)
+        if fmt is None:
+            yield event.plain_result("❌ 格式仅支持：jsonl/csv")
+            return
+        try:
+            n = await asyncio.to_thread(_write_export, path, list(self.command_map.items()), fmt)
+        except Exception as e:
+            yield event.plain_result(f"❌ 导出失败: {str(e)}")
+            return
+        yield event.plain_result(f"✅ 已导出 {n} 条到 {path}")
+
     @command("删除自定义回复")
     @permission_type(PermissionType.ADMIN)
-    async def delete_reply(self, event: AstrMessageEvent, keyword: str):
-        """/删除自定义回复 关键字 """
+    async def delete_reply(self, event: AstrMessageEvent, keyword: str, scope: str = ""):
+        """/删除自定义回复 关键字 [作用域]"""
         keyword = keyword.strip().lower()
+        scope_name = self._parse_scope(event, scope)
+        if scope_name is None:
+            yield event.plain_result(f"❌ 无法识别的作用域：{scope}")
+            return
+        if scope_name:
+            table = self.scopes.get(scope_name)
+            if table is None or keyword not in table.commands:
+                yield event.plain_result(f"❌ {scope_name} 中未找到关键词：{keyword}")
+                return
+            del table.commands[keyword]
+            self._persist_scoped(scope_name, keyword)
+            if not table.commands:
+                del self.scopes[scope_name]
+            yield event.plain_result(f"✅ 已删除关键词（{scope_name}）：{keyword}")
+            return
         if keyword not in self.command_map:
             yield event.plain_result(f"❌ 未找到关键词：{keyword}")
             return
         del self.command_map[keyword]
-        self._save_config(self.command_map)
+        self._refresh_fuzzy_index()
+        self._remove_command(keyword)
         yield event.plain_result(f"✅ 已删除关键词：{keyword}")
 
     @command("添加白名单")
@@ -293,7 +2845,7 @@ class CustomCommandPlugin(Star):
             yield event.plain_result("❌ 用户ID不能为空")
             return
         self.whitelist.add(uid)
-        self._save_whitelist()
+        self._persist_whitelist(uid, True)
         yield event.plain_result(f"✅ 已加入白名单：{uid}")
 
     @command("删除白名单")
@@ -303,7 +2855,7 @@ class CustomCommandPlugin(Star):
         uid = str(user_id).strip()
         if uid in self.whitelist:
             self.whitelist.remove(uid)
-            self._save_whitelist()
+            self._persist_whitelist(uid, False)
             yield event.plain_result(f"✅ 已从白名单移除：{uid}")
         else:
             yield event.plain_result(f"ℹ️ 白名单中不存在：{uid}")
@@ -333,6 +2885,167 @@ class CustomCommandPlugin(Star):
             return
         yield event.plain_result(f"✅ 白名单已{'开启' if self.whitelist_enabled else '关闭'}")
 
+    @command("插件统计")
+    @permission_type(PermissionType.ADMIN)
+    async def show_metrics(self, event: AstrMessageEvent, arg: str = "10"):
+        """/插件统计 [前N个热门关键词|重置] —— 查看命中计数与接口延迟"""
+        arg = str(arg).strip()
+        if arg == "重置":
+            self.metrics = PluginMetrics()
+            yield event.plain_result("✅ 统计已重置")
+            return
+        try:
+            top_n = max(1, int(arg or 10))
+        except ValueError:
+            yield event.plain_result("❌ 参数应为数字或“重置”")
+            return
+        m = self.metrics
+        lines = [
+            f"统计开始于 {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(m.started_at))}",
+            f"精确命中：{m.exact_hits}  模糊命中：{m.fuzzy_hits}  未命中：{m.misses}  白名单拦截：{m.whitelist_rejected}",
+        ]
+        if m.typo_hits:
+            lines.append(f"容错匹配命中：{m.typo_hits}（已计入模糊命中）")
+        if m.retries or m.hedges:
+            lines.append(f"接口重试：{m.retries}  对冲请求：{m.hedges}（对冲先返回 {m.hedge_wins}）")
+        cd = m.cooldown_suppressed
+        if self._cooldown_on or any(cd.values()):
+            lines.append(f"冷却忽略：发送者 {cd['sender']}  关键词 {cd['keyword']}  群 {cd['group']}"
+                         f"（冷却表记录 {len(self.cooldowns)} 条）")
+        if m.keyword_hits:
+            top = sorted(m.keyword_hits.items(), key=lambda kv: kv[1], reverse=True)[:top_n]
+            lines.append("热门关键词：")
+            lines.extend(f"  {k}：{n}" for k, n in top)
+        if m.endpoints:
+            lines.append("接口延迟（按直方图估算）：")
+            for ep, st in m.endpoints.items():
+                statuses = " ".join(f"{'超时/错误' if code is None else code}×{n}" for code, n in st.statuses.items())
+                lines.append(f"  {ep}\n    次数={st.count} 平均={st.total / st.count * 1000:.0f}ms "
+                             f"p50≤{st.quantile(0.5):g}s p99≤{st.quantile(0.99):g}s [{statuses}]")
+        yield event.plain_result("\n".join(lines))
+
+    def _render_prometheus(self) -> str:
+        """把当前指标渲染为 Prometheus 文本格式"""
+        m = self.metrics
+        out = [
+            "# TYPE custom_command_messages_total counter",
+            f'custom_command_messages_total{{result="exact"}} {m.exact_hits}',
+            f'custom_command_messages_total{{result="fuzzy"}} {m.fuzzy_hits}',
+            f'custom_command_messages_total{{result="miss"}} {m.misses}',
+            f'custom_command_messages_total{{result="whitelist_rejected"}} {m.whitelist_rejected}',
+            "# TYPE custom_command_typo_hits_total counter",
+            f"custom_command_typo_hits_total {m.typo_hits}",
+            "# TYPE custom_command_cooldown_suppressed_total counter",
+        ]
+        for kind, n in m.cooldown_suppressed.items():
+            out.append(f'custom_command_cooldown_suppressed_total{{dimension="{kind}"}} {n}')
+        out.append("# TYPE custom_command_api_retries_total counter")
+        out.append(f"custom_command_api_retries_total {m.retries}")
+        out.append("# TYPE custom_command_api_hedges_total counter")
+        out.append(f'custom_command_api_hedges_total{{result="sent"}} {m.hedges}')
+        out.append(f'custom_command_api_hedges_total{{result="won"}} {m.hedge_wins}')
+        out.append("# TYPE custom_command_keyword_hits_total counter")
+        for k, n in m.keyword_hits.items():
+            out.append(f'custom_command_keyword_hits_total{{keyword="{_prom_label(k)}"}} {n}')
+        out.append("# TYPE custom_command_api_latency_seconds histogram")
+        for ep, st in m.endpoints.items():
+            label = _prom_label(ep)
+            cumulative = 0
+            for i, n in enumerate(st.buckets):
+                cumulative += n
+                le = f"{st.BOUNDS[i]:g}" if i < len(st.BOUNDS) else "+Inf"
+                out.append(f'custom_command_api_latency_seconds_bucket{{endpoint="{label}",le="{le}"}} {cumulative}')
+            out.append(f'custom_command_api_latency_seconds_sum{{endpoint="{label}"}} {st.total}')
+            out.append(f'custom_command_api_latency_seconds_count{{endpoint="{label}"}} {st.count}')
+        out.append("# TYPE custom_command_api_responses_total counter")
+        for ep, st in m.endpoints.items():
+            label = _prom_label(ep)
+            for code, n in st.statuses.items():
+                out.append(f'custom_command_api_responses_total{{endpoint="{label}",status="{code or "error"}"}} {n}')
+        out.append("# TYPE custom_command_cache_requests_total counter")
+        out.append(f'custom_command_cache_requests_total{{result="hit"}} {self.response_cache.hits}')
+        out.append(f'custom_command_cache_requests_total{{result="miss"}} {self.response_cache.misses}')
+        out.append("# TYPE custom_command_coalesced_requests_total counter")
+        out.append(f"custom_command_coalesced_requests_total {self.coalesced_requests}")
+        q = self.job_queue
+        if q is not None:
+            out.append("# TYPE custom_command_queue_depth gauge")
+            out.append(f"custom_command_queue_depth {len(q)}")
+            out.append("# TYPE custom_command_queue_running gauge")
+            out.append(f"custom_command_queue_running {q.running}")
+            out.append("# TYPE custom_command_queue_jobs_total counter")
+            for result, n in q.counts.items():
+                out.append(f'custom_command_queue_jobs_total{{result="{result}"}} {n}')
+            out.append("# TYPE custom_command_queue_wait_seconds histogram")
+            cumulative = 0
+            for i, n in enumerate(q.wait.buckets):
+                cumulative += n
+                le = f"{q.wait.BOUNDS[i]:g}" if i < len(q.wait.BOUNDS) else "+Inf"
+                out.append(f'custom_command_queue_wait_seconds_bucket{{le="{le}"}} {cumulative}')
+            out.append(f"custom_command_queue_wait_seconds_sum {q.wait.total}")
+            out.append(f"custom_command_queue_wait_seconds_count {q.wait.count}")
+        return "\n".join(out) + "\n"
+
+    async def _dump_metrics_loop(self):
+        """定期把指标写入 metrics_prom_path，供 node_exporter textfile 等采集"""
+        while True:
+            await asyncio.sleep(max(1.0, float(self.settings.get("metrics_dump_interval") or 15)))
+            name = str(self.settings.get("metrics_prom_path") or "").strip()
+            if not name:
+                continue
+            try:
+                text = self._render_prometheus()
+                await asyncio.to_thread(_atomic_write_text, os.path.join(self.plugin_data_dir, name), text)
+            except Exception as e:
+                logger.error(f"指标导出失败: {str(e)}")
+
+    @command("重载词库")
+    @permission_type(PermissionType.ADMIN)
+    async def reload_files(self, event: AstrMessageEvent):
+        """立即从磁盘重新加载关键词、白名单与令牌"""
+        await self.persister.flush()
+        reloaded = await self._reload_changed(force=True)
+        sources = {"config": self.config_path, "whitelist": self.whitelist_path,
+                   "tokens": self.tokens_path, "scoped": self.scoped_path}
+        # 只记录成功重载的文件；失败的保持“已变更”，后台轮询会继续重试
+        for name in reloaded:
+            self._remember_file_sig(sources[name])
+        msg = (f"✅ 已重新加载：{len(self.command_map)} 个关键词，{len(self.scopes)} 个群/用户作用域，"
+               f"{len(self.whitelist)} 个白名单，{len(self.token_list)} 个令牌")
+        failed = [os.path.basename(sources[n]) for n in sorted(sources.keys() - reloaded)]
+        if failed:
+            msg += f"\n⚠️ 未能重载：{'、'.join(failed)}（已保留当前内容，详见日志）"
+        yield event.plain_result(msg)
+
+    @command("调试日志")
+    @permission_type(PermissionType.ADMIN)
+    async def toggle_debug_log(self, event: AstrMessageEvent, on_off: str = "开", sample_rate: str = ""):
+        """/调试日志 开|关 [采样比例0~1] —— 运行时切换逐条消息的调试日志"""
+        flag = str(on_off).strip().lower()
+        if flag in ("开", "on", "true", "1"):
+            self.settings["debug_log"] = True
+        elif flag in ("关", "off", "false", "0"):
+            self.settings["debug_log"] = False
+        else:
+            yield event.plain_result("❌ 参数仅支持：开/关")
+            return
+        if str(sample_rate).strip():
+            try:
+                rate = float(str(sample_rate).strip())
+            except Exception:
+                yield event.plain_result("❌ 采样比例必须是 0~1 之间的数字")
+                return
+            if not 0 <= rate <= 1:
+                yield event.plain_result("❌ 采样比例必须是 0~1 之间的数字")
+                return
+            self.settings["debug_sample_rate"] = rate
+        self._save_settings()
+        self._apply_log_settings()
+        if self._trace:
+            yield event.plain_result(f"✅ 调试日志已开启，采样比例 {self._trace_rate:g}")
+        else:
+            yield event.plain_result("✅ 调试日志已关闭")
+
     @command("设置API令牌")
     @permission_type(PermissionType.ADMIN)
     async def set_api_token(self, event: AstrMessageEvent, token: str):
@@ -369,6 +3082,8 @@ class CustomCommandPlugin(Star):
             yield event.plain_result(f"❌ 索引越界：{i}（当前共有 {len(self.token_list)} 个令牌）")
             return
         self.token_list.pop(i)
+        # 索引整体前移，旧的运行状态不再对应
+        self.token_limiter.reset()
         self._save_tokens()
         yield event.plain_result(f"✅ 已删除索引 {i} 的令牌")
 
@@ -402,10 +3117,387 @@ class CustomCommandPlugin(Star):
         lines = []
         for i, tok in enumerate(self.token_list):
             masked = self._mask_token(tok)
-            lines.append(f"{i}. {masked} (len={len(tok)})")
+            lines.append(f"{i}. {masked} (len={len(tok)}) {self.token_limiter.describe(i)}")
         msg = "令牌列表（索引从 0 开始）：\n" + "\n".join(lines)
         yield event.plain_result(msg)
 
+    @command("队列状态")
+    @permission_type(PermissionType.ADMIN)
+    async def queue_status(self, event: AstrMessageEvent):
+        """/队列状态 —— 查看接口任务队列的深度、执行数与等待时长"""
+        q = self.job_queue
+        if q is None:
+            yield event.plain_result("ℹ️ 任务队列未启用（/插件设置 queue_workers 数量 可开启）")
+            return
+        c = q.counts
+        lines = [
+            f"worker：{q.running}/{q.workers} 执行中  排队：{len(q)}/{q.max_depth}  策略：{q.policy}",
+            f"提交 {c['submitted']}  完成 {c['completed']}  拒绝 {c['rejected']}  挤出 {c['dropped']}  合并 {c['collapsed']}",
+        ]
+        if q.wait.count:
+            lines.append(f"排队等待：平均 {q.wait.total / q.wait.count * 1000:.0f}ms  "
+                         f"p50≤{q.wait.quantile(0.5):g}s  p99≤{q.wait.quantile(0.99):g}s")
+        yield event.plain_result("\n".join(lines))
+
+    @command("插件设置")
+    @permission_type(PermissionType.ADMIN)
+    async def plugin_settings(self, event: AstrMessageEvent, key: str = "", value: str = ""):
+        """/插件设置 [键] [值] —— 不带参数查看全部设置，带键值则修改"""
+        key = str(key).strip()
+        if not key:
+            lines = [f"{k} = {json.dumps(v, ensure_ascii=False)}" for k, v in self.settings.items()]
+            yield event.plain_result("当前插件设置：\n" + "\n".join(lines))
+            return
+        if key not in DEFAULT_SETTINGS:
+            yield event.plain_result(f"❌ 未知设置项：{key}")
+            return
+        if str(value).strip() == "":
+            yield event.plain_result(f"{key} = {json.dumps(self.settings[key], ensure_ascii=False)}")
+            return
+        default = DEFAULT_SETTINGS[key]
+        # 文本类设置按原样保存，避免 "123"/"true" 之类的回复文本被转成数字或布尔
+        new_value = str(value).strip() if isinstance(default, str) else self._auto_cast(str(value).strip())
+        if not _setting_type_ok(key, new_value):
+            if isinstance(default, bool):
+                expected = "true/false"
+            elif isinstance(default, (int, float)):
+                expected = "数字"
+            else:
+                expected = "JSON 对象，例如 {\"1\": {\"rate\": 2, \"burst\": 4}}"
+            yield event.plain_result(f"❌ {key} 需要{expected}")
+            return
+        if key == "storage_backend" and new_value not in ("json", "sqlite"):
+            yield event.plain_result("❌ storage_backend 仅支持：json/sqlite")
+            return
+        if key == "queue_policy" and new_value not in JobQueue.POLICIES:
+            yield event.plain_result(f"❌ queue_policy 仅支持：{'/'.join(JobQueue.POLICIES)}")
+            return
+        self.settings[key] = new_value
+        self._save_settings()
+        if key == "persist_delay":
+            self.persister.delay = max(0.0, float(new_value))
+        if key == "cache_max_entries":
+            self.response_cache = ResponseCache(new_value)
+        if key.startswith("debug_"):
+            self._apply_log_settings()
+        if key.startswith("cooldown_"):
+            self._apply_cooldown_settings()
+        if key.startswith("typo_"):
+            self._apply_typo_settings()
+        if key.startswith("queue_") and key != "queue_ack":
+            # 旧队列执行完已排队的任务后自行退出，新触发进入新队列
+            if self.job_queue is not None:
+                self.job_queue.drain()
+            self.job_queue = self._create_job_queue()
+        if key.startswith("token_"):
+            self.token_limiter.configure(self.settings)
+        if key.startswith("http_"):
+            # 连接参数变化后重建客户端
+            old_client = self.http_client
+            self._host_slots = {}
+            self.http_client = self._create_http_client()
+            await self._close_http_client(old_client)
+        note = "（重载插件后生效）" if key == "storage_backend" else ""
+        yield event.plain_result(f"✅ 已设置 {key} = {json.dumps(new_value, ensure_ascii=False)}{note}")
+
+    @command("设置缓存")
+    @permission_type(PermissionType.ADMIN)
+    async def set_cache_ttl(self, event: AstrMessageEvent, keyword: str, seconds: str):
+        """/设置缓存 关键词 秒数 —— 为 GET 接口关键词设置响应缓存时长，0 表示不缓存"""
+        key = keyword.strip().lower()
+        v = self.command_map.get(key)
+        if not isinstance(v, dict) or v.get("type") != "get_api":
+            yield event.plain_result(f"❌ {key} 不是 GET 接口关键词")
+            return
+        try:
+            ttl = float(str(seconds).strip())
+        except Exception:
+            yield event.plain_result("❌ 秒数必须是数字")
+            return
+        if ttl > 0:
+            v["cache_ttl"] = ttl
+        else:
+            v.pop("cache_ttl", None)
+        self._commit_command(key)
+        yield event.plain_result(f"✅ {key} 的缓存时长已设置为 {ttl:g} 秒" if ttl > 0 else f"✅ 已关闭 {key} 的缓存")
+
+    @command("设置冷却")
+    @permission_type(PermissionType.ADMIN)
+    async def set_cooldown(self, event: AstrMessageEvent, keyword: str, seconds: str):
+        """/设置冷却 关键词 秒数 —— 为接口关键词单独设置两次触发的最小间隔，0 表示使用全局 cooldown_keyword"""
+        key = keyword.strip().lower()
+        v = self.command_map.get(key)
+        if not isinstance(v, dict) or v.get("type") not in ("get_api", "post_api"):
+            yield event.plain_result(f"❌ {key} 不是接口关键词（文本关键词请使用 /插件设置 cooldown_keyword）")
+            return
+        try:
+            cooldown = float(str(seconds).strip())
+        except Exception:
+            yield event.plain_result("❌ 秒数必须是数字")
+            return
+        if cooldown > 0:
+            v["cooldown"] = cooldown
+        else:
+            v.pop("cooldown", None)
+        self._commit_command(key)
+        yield event.plain_result(f"✅ {key} 的冷却时间已设置为 {cooldown:g} 秒" if cooldown > 0
+                                 else f"✅ {key} 已改用全局冷却设置")
+
+    @command("设置轮询")
+    @permission_type(PermissionType.ADMIN)
+    async def set_poll(self, event: AstrMessageEvent, keyword: str, seconds: str):
+        """/设置轮询 关键词 秒数 —— GET 接口关键词在后台定时刷新，触发时直接返回最近结果；0 表示关闭"""
+        key = keyword.strip().lower()
+        v = self.command_map.get(key)
+        if not isinstance(v, dict) or v.get("type") != "get_api":
+            yield event.plain_result(f"❌ {key} 不是 GET 接口关键词")
+            return
+        try:
+            interval = float(str(seconds).strip())
+        except Exception:
+            yield event.plain_result("❌ 秒数必须是数字")
+            return
+        if 0 < interval < 1:
+            yield event.plain_result("❌ 轮询间隔不能小于 1 秒")
+            return
+        if interval > 0:
+            v["poll_interval"] = interval
+        else:
+            v.pop("poll_interval", None)
+        self._commit_command(key)
+        if interval > 0:
+            yield event.plain_result(f"✅ {key} 每 {interval:g} 秒预热一次，"
+                                     f"{self.settings['poll_idle_seconds']} 秒无人触发后暂停")
+        else:
+            yield event.plain_result(f"✅ 已关闭 {key} 的预热轮询")
+
+    @command("设置重试")
+    @permission_type(PermissionType.ADMIN)
+    async def set_retry(self, event: AstrMessageEvent, keyword: str, attempts: str, backoff: str = "0.2",
+                        statuses: str = "[]", idempotent: str = ""):
+        """/设置重试 关键词 最多尝试次数 [基础退避秒] [可重试状态码列表] [幂等] —— 次数为 1 表示不重试；POST 需声明幂等才会重试"""
+        key = keyword.strip().lower()
+        v = self.command_map.get(key)
+        if not isinstance(v, dict) or v.get("type") not in ("get_api", "post_api"):
+            yield event.plain_result(f"❌ {key} 不是 GET/POST 接口关键词")
+            return
+        try:
+            n = int(str(attempts).strip())
+            base = float(str(backoff).strip() or 0.2)
+            codes = [int(c) for c in self._parse_list_input(statuses)]
+        except Exception:
+            yield event.plain_result("❌ 次数、退避秒数与状态码必须是数字")
+            return
+        if n <= 1:
+            v.pop("retry", None)
+            self._commit_command(key)
+            yield event.plain_result(f"✅ 已关闭 {key} 的重试")
+            return
+        is_post = v.get("type") == "post_api"
+        if is_post and str(idempotent).strip() not in ("幂等", "idempotent"):
+            yield event.plain_result("❌ POST 请求可能有副作用，确认重复执行安全时请在末尾加上“幂等”")
+            return
+        retry = {"attempts": n, "backoff": base, "max_backoff": max(base, 2.0)}
+        if codes:
+            retry["statuses"] = codes
+        if is_post:
+            retry["post"] = True
+        v["retry"] = retry
+        self._commit_command(key)
+        shown = codes or list(RetryPolicy.DEFAULT_STATUSES)
+        yield event.plain_result(f"✅ {key} 最多尝试 {n} 次，退避基数 {base:g} 秒，重试状态码 {shown} 及超时/连接错误")
+
+    @command("设置对冲")
+    @permission_type(PermissionType.ADMIN)
+    async def set_hedge(self, event: AstrMessageEvent, keyword: str, quantile: str = "0.95"):
+        """/设置对冲 关键词 [分位数0~1] —— GET 请求超过该接口历史耗时分位数仍未返回时再发一个，取先返回者；0 表示关闭"""
+        key = keyword.strip().lower()
+        v = self.command_map.get(key)
+        if not isinstance(v, dict) or v.get("type") != "get_api":
+            yield event.plain_result(f"❌ {key} 不是 GET 接口关键词（POST 不支持对冲）")
+            return
+        try:
+            q = float(str(quantile).strip())
+        except Exception:
+            yield event.plain_result("❌ 分位数必须是 0~1 之间的数字")
+            return
+        if q <= 0:
+            v.pop("hedge", None)
+            self._commit_command(key)
+            yield event.plain_result(f"✅ 已关闭 {key} 的对冲请求")
+            return
+        if q >= 1:
+            yield event.plain_result("❌ 分位数必须是 0~1 之间的数字")
+            return
+        v["hedge"] = q
+        self._commit_command(key)
+        yield event.plain_result(f"✅ {key} 耗时超过 p{q * 100:g} 时发出对冲请求（需积累 20 次以上的延迟样本）")
+
+    @command("设置模板")
+    @permission_type(PermissionType.ADMIN)
+    async def set_template(self, event: AstrMessageEvent, keyword: str, template: str = ""):
+        """/设置模板 关键词 模板 —— 只回复模板中的字段，如 状态:{attributes.current_state}\\n内存:{attributes.resources.memory_bytes|bytes}；留空取消"""
+        key = keyword.strip().lower()
+        v = self.command_map.get(key)
+        if not isinstance(v, dict) or v.get("type") not in ("get_api", "post_api"):
+            yield event.plain_result(f"❌ {key} 不是 GET/POST 接口关键词")
+            return
+        text = str(template or "").replace("\\n", "\n")
+        if not text.strip():
+            v.pop("template", None)
+            self._commit_command(key)
+            yield event.plain_result(f"✅ 已取消 {key} 的回复模板")
+            return
+        try:
+            ResponseTemplate(text)
+        except ValueError as e:
+            yield event.plain_result(f"❌ 模板无效：{e}")
+            return
+        v["template"] = text
+        self._commit_command(key)
+        yield event.plain_result(f"✅ 已设置 {key} 的回复模板：\n{text}")
+
+    @command("合并请求")
+    @permission_type(PermissionType.ADMIN)
+    async def set_coalesce(self, event: AstrMessageEvent, keyword: str, on_off: str = "开"):
+        """/合并请求 关键词 开|关 —— 是否合并该接口关键词的并发相同请求（有副作用的 POST 建议关闭）"""
+        key = keyword.strip().lower()
+        v = self.command_map.get(key)
+        if not isinstance(v, dict) or v.get("type") not in ("get_api", "post_api"):
+            yield event.plain_result(f"❌ {key} 不是接口关键词")
+            return
+        flag = str(on_off).strip().lower()
+        if flag in ("开", "on", "true", "1"):
+            v.pop("coalesce", None)
+        elif flag in ("关", "off", "false", "0"):
+            v["coalesce"] = False
+        else:
+            yield event.plain_result("❌ 参数仅支持：开/关")
+            return
+        self._commit_command(key)
+        yield event.plain_result(f"✅ {key} 的并发合并已{'开启' if v.get('coalesce', True) else '关闭'}")
+
+    @command("缓存状态")
+    @permission_type(PermissionType.ADMIN)
+    async def cache_status(self, event: AstrMessageEvent):
+        """查看 GET 响应缓存的条目数与命中率"""
+        c = self.response_cache
+        total = c.hits + c.misses
+        rate = f"{c.hits / total * 100:.1f}%" if total else "-"
+        lines = [f"缓存条目：{len(c)}/{c.max_entries}", f"命中：{c.hits}  未命中：{c.misses}  命中率：{rate}"]
+        ttl_keys = [f"{k} ({v['cache_ttl']:g}s)" for k, v in self.command_map.items()
+                    if isinstance(v, dict) and v.get("cache_ttl")]
+        if ttl_keys:
+            lines.append("已启用缓存的关键词：" + "、".join(ttl_keys))
+        lines.append(f"并发合并的请求：{self.coalesced_requests}（进行中 {len(self._inflight)}）")
+        if self._polls:
+            now = time.monotonic()
+            polls = [f"{st.entry.keyword}（{now - st.snapshot_at:.0f} 秒前）" if st.snapshot is not None
+                     else f"{st.entry.keyword}（暂无快照）" for st in self._polls.values()]
+            lines.append("正在预热轮询：" + "、".join(polls))
+        yield event.plain_result("\n".join(lines))
+
+    @command("清空缓存")
+    @permission_type(PermissionType.ADMIN)
+    async def cache_clear(self, event: AstrMessageEvent):
+        """清空 GET 响应缓存并重置命中统计"""
+        n = len(self.response_cache)
+        self.response_cache.clear()
+        yield event.plain_result(f"✅ 已清空 {n} 条缓存")
+
+    @command("熔断状态")
+    @permission_type(PermissionType.ADMIN)
+    async def breaker_status(self, event: AstrMessageEvent):
+        """查看各接口主机的熔断状态"""
+        if not self.breakers:
+            yield event.plain_result("暂无接口调用记录")
+            return
+        names = {"closed": "正常", "open": "熔断", "half_open": "半开探测"}
+        open_seconds = float(self.settings["breaker_open_seconds"])
+        now = time.monotonic()
+        lines = []
+        for host, b in self.breakers.items():
+            line = f"{host}: {names[b.state]} 连续失败={b.failures} 熔断次数={b.trips} 快速失败={b.rejected}"
+            if b.state == "open":
+                line += f" 剩余{max(0.0, open_seconds - (now - b.opened_at)):.0f}s"
+            if b.state != "closed" and b.last_error:
+                line += f"\n  最近错误：{b.last_error}"
+            lines.append(line)
+        yield event.plain_result("接口熔断状态：\n" + "\n".join(lines))
+
+    @command("熔断重置")
+    @permission_type(PermissionType.ADMIN)
+    async def breaker_reset(self, event: AstrMessageEvent, host: str = ""):
+        """/熔断重置 [主机] —— 手动恢复指定主机（不填则全部）的熔断器"""
+        host = str(host).strip()
+        if host:
+            if host not in self.breakers:
+                yield event.plain_result(f"❌ 未找到主机：{host}")
+                return
+            self.breakers[host] = CircuitBreaker()
+            yield event.plain_result(f"✅ 已重置 {host} 的熔断器")
+            return
+        self.breakers.clear()
+        yield event.plain_result("✅ 已重置全部熔断器")
+
+    @command("tokenPool")
+    @permission_type(PermissionType.ADMIN)
+    async def token_pool(self, event: AstrMessageEvent, keyword: str, indices: str = "[]", strategy: str = "rr"):
+        """/tokenPool 关键词 索引列表 [rr|least] —— 让接口关键词在多个令牌间轮询或按最少进行中分配；索引列表为空则取消"""
+        key = keyword.strip().lower()
+        v = self.command_map.get(key)
+        if not isinstance(v, dict) or v.get("type") not in ("get_api", "post_api"):
+            yield event.plain_result(f"❌ {key} 不是接口关键词")
+            return
+        try:
+            pool = [int(x) for x in self._parse_list_input(indices)]
+        except Exception:
+            yield event.plain_result("❌ 索引列表必须是整数")
+            return
+        if not pool:
+            v.pop("token_pool", None)
+            v.pop("pool_strategy", None)
+            self._commit_command(key)
+            yield event.plain_result(f"✅ 已取消 {key} 的令牌池")
+            return
+        bad = [i for i in pool if i < 0 or i >= len(self.token_list)]
+        if bad:
+            yield event.plain_result(f"❌ 索引越界：{bad}（当前共有 {len(self.token_list)} 个令牌）")
+            return
+        mode = str(strategy).strip().lower()
+        if mode in ("rr", "round_robin"):
+            mode = "round_robin"
+        elif mode in ("least", "least_inflight"):
+            mode = "least_inflight"
+        else:
+            yield event.plain_result("❌ 调度策略仅支持：rr/least")
+            return
+        v["token_pool"] = pool
+        v["pool_strategy"] = mode
+        self._commit_command(key)
+        yield event.plain_result(f"✅ {key} 使用令牌池 {pool}（{mode}）")
+
+    @command("tokenLimit")
+    @permission_type(PermissionType.ADMIN)
+    async def token_limit(self, event: AstrMessageEvent, index: str, rate: str, burst: str = ""):
+        """/tokenLimit 索引 每秒请求数 [突发容量] —— 单独设置某个令牌的限速，每秒请求数为 0 表示不限速"""
+        try:
+            i = int(str(index).strip())
+            r = float(str(rate).strip())
+            b = float(str(burst).strip()) if str(burst).strip() else float(self.settings["token_burst"])
+        except Exception:
+            yield event.plain_result("❌ 参数必须是数字")
+            return
+        if i < 0 or i >= len(self.token_list):
+            yield event.plain_result(f"❌ 索引越界：{i}（当前共有 {len(self.token_list)} 个令牌）")
+            return
+        limits = dict(self.settings.get("token_limits") or {})
+        limits[str(i)] = {"rate": r, "burst": b}
+        self.settings["token_limits"] = limits
+        self._save_settings()
+        self.token_limiter.configure(self.settings)
+        yield event.plain_result(f"✅ 令牌 {i} 限速：{r:g} 次/秒，突发 {b:g}" if r > 0 else f"✅ 令牌 {i} 不限速")
+
     def _mask_token(self, tok: str) -> str:
         """对令牌做脱敏展示：保留前4后4，其余以*代替。"""
         if not isinstance(tok, str):
@@ -415,6 +3507,40 @@ class CustomCommandPlugin(Star):
             return "*" * n
         return f"{tok[:4]}{'*' * (n - 8)}{tok[-4:]}"
 
+    @command("批量接口")
+    @permission_type(PermissionType.ADMIN)
+    async def add_fanout(self, event: AstrMessageEvent, keyword: str, target_keywords: str, concurrency: str = "",
+                         timeout: str = ""):
+        """/批量接口 关键词 [接口关键词1,接口关键词2] [并发数] [单个超时秒数] —— 把已有接口关键词组合为一次并发执行的批量关键词"""
+        key = keyword.strip().lower()
+        names = [str(x).strip().lower() for x in self._parse_list_input(target_keywords) if str(x).strip()]
+        if not names:
+            yield event.plain_result("❌ 至少需要一个目标关键词")
+            return
+        targets = []
+        for name in names:
+            v = self.command_map.get(name)
+            if not isinstance(v, dict) or v.get("type") not in ("get_api", "post_api"):
+                yield event.plain_result(f"❌ {name} 不是 GET/POST 接口关键词")
+                return
+            target = {k: val for k, val in v.items() if k != "type" and val is not None}
+            target["name"] = name
+            target["method"] = "POST" if v["type"] == "post_api" else "GET"
+            targets.append(target)
+        value = {"type": "multi_api", "targets": targets}
+        try:
+            if str(concurrency).strip():
+                value["concurrency"] = int(str(concurrency).strip())
+            if str(timeout).strip():
+                value["timeout"] = float(str(timeout).strip())
+        except ValueError:
+            yield event.plain_result("❌ 并发数与超时必须是数字")
+            return
+        self.command_map[key] = value
+        self._refresh_fuzzy_index()
+        self._commit_command(key)
+        yield event.plain_result(f"✅ 已添加批量接口关键词 [{key}]：{len(targets)} 个目标（{', '.join(names)}）")
+
     @command("调用API")
     async def call_api(self, event: AstrMessageEvent, keyword: str, endpoint: str, api_index: str):
         """/调用API 关键词 接口地址 API列表索引"""
@@ -426,8 +3552,9 @@ class CustomCommandPlugin(Star):
             yield event.plain_result("❌ API列表索引必须是整数")
             return
         self.command_map[key] = {"type": "get_api", "endpoint": endpoint, "token_index": idx}
-        self._save_config(self.command_map)
-        ok, msg, _status = self._request_api("GET", endpoint, token_index=idx)
+        self._refresh_fuzzy_index()
+        self._commit_command(key)
+        ok, msg, _status = await self._request_api("GET", endpoint, token_index=idx)
         yield event.plain_result(msg)
 
     @command("调用POSTAPI")
@@ -445,7 +3572,8 @@ class CustomCommandPlugin(Star):
 
         self.command_map[key] = {"type": "post_api", "endpoint": endpoint, "payload": None, "code_map": None,
                                  "token_index": idx}
-        self._save_config(self.command_map)
+        self._refresh_fuzzy_index()
+        self._commit_command(key)
 
         # 解析数据键名与数据值
         keys = self._parse_list_input(data_keys)
@@ -476,138 +3604,207 @@ class CustomCommandPlugin(Star):
         # 持久化 payload 和 code_map
         self.command_map[key]["payload"] = payload
         self.command_map[key]["code_map"] = code_map
-        self._save_config(self.command_map)
+        self._commit_command(key)
 
-        ok, msg, status = self._request_api("POST", endpoint, payload, token_index=idx)
+        ok, msg, status = await self._request_api("POST", endpoint, payload, token_index=idx)
         if status is not None and code_map and status in code_map:
             yield event.plain_result(code_map[status])
             return
         yield event.plain_result(msg)
 
-    def _get_event_text(self, event) -> str:
-        """尽量从不同类型的 event/Context 中提取文本消息，兼容 message_str / get_message_str 等。"""
-        # 1) 直接属性或可调用属性 message_str
-        try:
-            v = getattr(event, "message_str", None)
-            if callable(v):
-                v = v()
-            if isinstance(v, str):
-                return v
-        except Exception:
-            pass
+    async def _coalesced_request(self, method: str, endpoint: str, payload: dict | bytes | None = None,
+                                 token_index: int | None = None, coalesce: bool = True,
+                                 token_pool: tuple | None = None, pool_strategy: str = "round_robin",
+                                 policy: RetryPolicy | None = None, template: ResponseTemplate | None = None):
+        """
+        合并并发的相同请求（method、endpoint、payload、令牌均相同）：只发一次上游调用，
+        所有等待者拿到同一个结果。请求完成即移除，不做任何缓存。
+        """
+        call = self._request_api(method, endpoint, payload, token_index=token_index,
+                                 token_pool=token_pool, pool_strategy=pool_strategy, policy=policy,
+                                 template=template)
+        if not coalesce:
+            return await call
+        if isinstance(payload, bytes):
+            body = payload
+        else:
+            body = json.dumps(payload, ensure_ascii=False, sort_keys=True) if payload else ""
+        key = (method.upper(), endpoint, body, token_pool or token_index, template.source if template else None)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(call)
+            self._inflight[key] = task
+            task.add_done_callback(lambda _t, k=key: self._inflight.pop(k, None))
+        else:
+            call.close()
+            self.coalesced_requests += 1
+        # shield：某个等待者被取消时不影响其他等待者
+        return await asyncio.shield(task)
 
-        # 2) 常见的取文本方法/属性
-        for name in ("get_message_str", "get_message_text", "get_text", "text"):
-            try:
-                attr = getattr(event, name, None)
-                val = attr() if callable(attr) else attr
-                if isinstance(val, str):
-                    return val
-            except Exception:
-                continue
+    async def _call_post_entry(self, e: CommandEntry):
+        """执行 post_api 关键词；coalesce 为 false 的关键词（有副作用）不参与合并"""
+        return await self._coalesced_request("POST", e.endpoint, e.payload_bytes, token_index=e.token_index,
+                                             coalesce=e.coalesce, token_pool=e.token_pool,
+                                             pool_strategy=e.pool_strategy, policy=e.retry,
+                                             template=e.template)
 
-        # 3) event.message 以及其 text 字段
-        try:
-            msg = getattr(event, "message", None)
-            if isinstance(msg, str):
-                return msg
-            if hasattr(msg, "text"):
-                t = msg.text
-                if isinstance(t, str):
-                    return t
-        except Exception:
-            pass
+    async def _call_get_entry(self, e: CommandEntry):
+        """执行 get_api 关键词：设置了 cache_ttl 的关键词优先读缓存，成功响应写回缓存"""
+        if e.cache_ttl <= 0:
+            return await self._coalesced_request("GET", e.endpoint, token_index=e.token_index, coalesce=e.coalesce,
+                                                 token_pool=e.token_pool, pool_strategy=e.pool_strategy,
+                                                 policy=e.retry, template=e.template)
+        cache_key = e.result_key
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        result = await self._coalesced_request("GET", e.endpoint, token_index=e.token_index, coalesce=e.coalesce,
+                                               token_pool=e.token_pool, pool_strategy=e.pool_strategy,
+                                               policy=e.retry, template=e.template)
+        if result[0]:
+            self.response_cache.put(cache_key, result, e.cache_ttl)
+        return result
 
-        return ""
+    def _get_event_text(self, event) -> str:
+        """
+        尽量从不同类型的 event/Context 中提取文本消息，兼容 message_str / get_message_str 等。
+        同一事件类型总是用同一种方式取值：首次探测后按类型缓存，缓存的方式失败时才重新探测。
+        """
+        getter = self._text_getters.get(type(event))
+        if getter is not None:
+            try:
+                v = getter(event)
+                if isinstance(v, str):
+                    return v
+            except Exception:
+                pass
+        v, getter = _probe_event_text(event)
+        if getter is None:
+            return ""
+        self._text_getters[type(event)] = getter
+        return v
 
     def _get_sender_id(self, event):
-        """兼容不同 event/Context 的取发送者ID方法。"""
-        # 优先使用统一方法
-        try:
-            fn = getattr(event, "get_sender_id", None)
-            if callable(fn):
-                return fn()
-        except Exception:
-            pass
-
-        # 常见属性名尝试
-        for name in ("sender_id", "user_id", "uid"):
+        """兼容不同 event/Context 的取发送者ID方法，按事件类型缓存探测结果。"""
+        getter = self._sender_getters.get(type(event))
+        if getter is not None:
             try:
-                v = getattr(event, name, None)
+                v = getter(event)
                 if v is not None:
                     return v
             except Exception:
-                continue
-
-        # 兼容 sender 对象
-        try:
-            sender = getattr(event, "sender", None)
-            if sender is not None:
-                for n in ("id", "user_id", "uid"):
-                    if hasattr(sender, n):
-                        return getattr(sender, n)
-        except Exception:
-            pass
+                pass
+        v, getter = _probe_sender_id(event)
+        if getter is not None:
+            self._sender_getters[type(event)] = getter
+        return v
 
-        return None
+    def _scope_layers(self, event) -> list:
+        """按优先级返回当前消息适用的作用域表（用户、群），不含全局"""
+        layers = []
+        sid = self._get_sender_id(event)
+        if sid is not None:
+            table = self.scopes.get(f"user:{sid}")
+            if table is not None:
+                layers.append(table)
+        gid = self._get_group_id(event)
+        if gid:
+            table = self.scopes.get(f"group:{gid}")
+            if table is not None:
+                layers.append(table)
+        return layers
 
     @event_message_type(EventMessageType.ALL)
     async def handle_message(self, event: AstrMessageEvent):
+        if not self._background_tasks:
+            self._start_background_tasks()
         raw = self._get_event_text(event)
         msg = (raw or "").strip().lower()
-        print(f"[DEBUG] 收到消息: {msg}")
+        # 调试日志默认关闭；关闭时只做一次布尔判断，不产生任何字符串格式化
+        trace = self._trace and (self._trace_rate >= 1.0 or random.random() < self._trace_rate)
+        if trace:
+            logger.debug("收到消息: %s", msg)
         # 白名单校验：仅当开启时才限制自动回复
         if self.whitelist_enabled:
-            print(f"[DEBUG] 白名单已开启，正在检查发送者ID...")
             sid = self._get_sender_id(event)
-            print(f"[DEBUG] 发送: {sid}")
             if sid is None or str(sid) not in self.whitelist:
-                print(f"[DEBUG] 发送者不在白名单内，忽略消息")
+                self.metrics.whitelist_rejected += 1
+                if trace:
+                    logger.debug("发送者 %s 不在白名单内，忽略消息", sid)
                 # 不在白名单则直接忽略，不打扰用户
                 return
-        v = self.command_map.get(msg)
-        print(f"[DEBUG] 匹配到的关键词映射: {v}")
-        if v is None:
-            print(f"[DEBUG] 尝试模糊匹配...")
-            # 模糊匹配文本回复（兼容旧逻辑）
-            for keyword, reply in self.command_map.items():
-                if isinstance(reply, str) and keyword in msg:
-                    print(f"[DEBUG] 模糊匹配成功: {keyword} -> {reply}")
-                    yield event.plain_result(reply)
+        entry = None
+        exact = True
+        layers = self._scope_layers(event) if self.scopes else ()
+        # 作用域优先级：用户 > 群 > 全局；先在各层精确匹配，全部落空再依次模糊匹配
+        for table in layers:
+            entry = table.get(msg)
+            if entry is not None:
+                break
+        if entry is None:
+            entry = self.entries.get(msg)
+        if entry is None:
+            exact = False
+            for table in layers:
+                entry = table.search(msg)
+                if entry is not None:
+                    break
+            else:
+                # 模糊匹配文本回复（兼容旧逻辑：按插入顺序第一个命中的关键词优先）
+                keyword = self.keyword_index.search(msg)
+                if keyword is None and self.typo_index is not None:
+                    # 精确与子串匹配都未命中，再按编辑距离容错匹配
+                    keyword = self.typo_index.search(msg, self._typo_distance, self._typo_similarity)
+                    if keyword is not None:
+                        self.metrics.typo_hits += 1
+                        if trace:
+                            logger.debug("容错匹配: %s -> %s", msg, keyword)
+                # 索引与条目可能刚被重载替换，取不到条目按未命中处理
+                entry = self.entries.get(keyword) if keyword is not None else None
+                if entry is None:
+                    self.metrics.misses += 1
+                    if trace:
+                        logger.debug("未匹配到关键词")
                     return
-            return
 
-        # 命中精确关键词，类型: {type(v)}
-        print(f"[DEBUG] 命中精确关键词，类型: {type(v)}")
-        if isinstance(v, dict):
-            vtype = v.get("type")
-            if vtype == "get_api":
-                print(f"[DEBUG] 调用 {vtype.upper()} 接口: {v.get('endpoint', '')}")
-                ok, out, _status = self._request_api("GET", v.get("endpoint", ""), token_index=v.get("token_index"))
-                yield event.plain_result(out)
-                return
-            if vtype == "post_api":
-                print(f"[DEBUG] 调用 {vtype.upper()} 接口: {v.get('endpoint', '')}")
-                ok, out, status = self._request_api("POST", v.get("endpoint", ""), v.get("payload") or {}, token_index=v.get("token_index"))
-                code_map = v.get("code_map") or {}
-                try:
-                    status_int = int(status) if status is not None else None
-                except Exception:
-                    status_int = None
-                if status_int is not None and status_int in code_map:
-                    yield event.plain_result(code_map[status_int])
-                else:
-                    yield event.plain_result(out)
+        if (self._cooldown_on or entry.cooldown) and self._cooldown_blocked(event, entry):
+            if trace:
+                logger.debug("关键词 %s 处于冷却中，忽略本次触发", entry.keyword)
+            return
+        self.metrics.hit(entry.keyword, exact)
+        if trace:
+            if exact:
+                logger.debug("命中精确关键词: %s -> %s", msg, entry.kind)
+            else:
+                logger.debug("模糊匹配成功: %s -> %s", entry.keyword, entry.reply)
+        kind = entry.kind
+        if kind == "text" or kind == "unknown":
+            yield event.plain_result(entry.reply)
+            return
+        if entry.error:
+            yield event.plain_result(entry.error)
+            return
+        if entry.poll_interval:
+            cached = self._snapshot_reply(entry)
+            if cached is not None:
+                yield event.plain_result(cached)
                 return
-            # 未知类型，回退为文本
-            yield event.plain_result(str(v))
+        queue = self.job_queue
+        if queue is None:
+            yield event.plain_result(await self._run_api_entry(entry))
             return
-
-        # 兼容旧版：纯文本回复
-        if isinstance(v, str):
-            print(f"[DEBUG] 返回纯文本回复: {v}")
-            yield event.plain_result(v)
+        # 排队执行：相同关键词只有允许合并请求时才会被 collapse 策略合并
+        future = queue.submit(entry if entry.coalesce else None, lambda: self._run_api_entry(entry))
+        if future is None:
+            if trace:
+                logger.debug("任务队列已满，拒绝关键词 %s", entry.keyword)
+            yield event.plain_result(queue.busy_reply)
             return
-
-        # 其他类型（理论不存在）
-        yield event.plain_result(str(v))
\ No newline at end of file
+        ack = self.settings.get("queue_ack")
+        if ack:
+            task = asyncio.ensure_future(self._deliver_later(event.unified_msg_origin, future))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+            yield event.plain_result(ack)
+            return
+        yield event.plain_result(await asyncio.shield(future))